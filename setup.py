@@ -18,21 +18,20 @@ KEYWORDS = []
 CLASSIFIERS = [
     'Development Status :: 3 - Alpha',
     'Framework :: Django',
-    'Framework :: Django :: 1.7',
-    'Framework :: Django :: 1.8',
+    'Framework :: Django :: 1.9',
+    'Framework :: Django :: 1.10',
     'Framework :: Django :: 2.0',
     'Intended Audience :: Developers',
     'License :: OSI Approved :: MIT License',
     'Natural Language :: English',
     'Programming Language :: Python :: 3',
-    'Programming Language :: Python :: 3.3',
     'Programming Language :: Python :: 3.4',
     'Programming Language :: Python :: 3.5',
     'Programming Language :: Python :: 3.6',
 ]
-INSTALL_REQUIRES = ['Django>=1.8']
+INSTALL_REQUIRES = ['Django>=1.9']
 TEST_SUITE = 'runtests.run_tests'
-TESTS_REQUIRE = ['Django>=1.8']
+TESTS_REQUIRE = ['Django>=1.9']
 
 ###############################################################################
 
@@ -1,13 +1,19 @@
-from django import VERSION
+from django.conf import settings
 from django.core.exceptions import (
     MultipleObjectsReturned,
     ObjectDoesNotExist,
-    FieldDoesNotExist)
+    FieldDoesNotExist,
+    ValidationError)
 from django.contrib.contenttypes.fields import ContentType
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import BooleanField, Case, Value, When
 from django.db.models.query_utils import Q
 from .models import ExternalKeyMapping
 from collections import defaultdict
+from functools import lru_cache
+import inspect
 import logging
+import operator
 from .logging import StyleAdapter
 
 """
@@ -26,13 +32,137 @@ logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler()) # http://pieces.openpolitics.com/2012/04/python-logging-best-practices/
 logger = StyleAdapter(logger)
 
+
+@lru_cache(maxsize=1024)
+def _get_field(model, name):
+    """
+    model._meta.get_field(), memoized per model class and field name.
+
+    :return: The field, or None if the model does not have such a field
+    """
+    try:
+        return model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+
+
+@lru_cache(maxsize=128)
+def _field_plan(model, attributes):
+    """
+    Work out how update_from_fields() handles each of the attributes used
+    for the fields of an action, memoized per model class and set of
+    attribute names (i.e. per input file layout).
+
+    :return: A list of (attribute, referential attribute, current value
+        attribute, nullable, changed field, instance dict key) tuples, where:
+        - the referential attribute is the (own attribute, referred to
+          attribute) pair for referential attributes and None otherwise
+        - the current value attribute is the attribute to read to check if
+          the object already has a value (for concrete fields, the column)
+        - nullable is whether '' should be stored as None
+        - the changed field is the name of the concrete field that setting
+          the attribute changes, or None
+        - the instance dict key is the key to store the value under in the
+          object's __dict__ directly, for plain fields that setting the
+          attribute would not treat specially, or None
+    """
+    plan = []
+    for attribute in attributes:
+        if ModelAction.REFERRED_TO_DELIMITER in attribute:
+            own_attribute, referred_attribute = attribute.split(
+                ModelAction.REFERRED_TO_DELIMITER)[:2]
+            referential = (own_attribute, referred_attribute)
+        else:
+            referential = None
+
+        field = _get_field(model, attribute)
+        if field is None:
+            plan.append((attribute, referential, attribute, False, None,
+                         None))
+            continue
+        # Read the column value, so that a foreign key does not load the
+        # related object
+        current_attribute = field.attname if field.concrete else attribute
+        # The primary key identifies the row to write, rather than being
+        # written itself (and bulk_update() refuses to write it)
+        changed_field = (field.name
+                         if (field.concrete and not field.many_to_many and
+                             not field.primary_key)
+                         else None)
+        dict_key = None
+        if (field.concrete and not field.is_relation and
+                field.attname == attribute):
+            descriptor = inspect.getattr_static(model, attribute, None)
+            if not hasattr(type(descriptor), '__set__'):
+                dict_key = attribute
+        plan.append((attribute, referential, current_attribute, field.null,
+                     changed_field, dict_key))
+    return plan
+
+
+@lru_cache(maxsize=None)
+def _auto_now_fields(model):
+    """
+    The model's concrete fields that are set to the current date/time
+    whenever the object is saved, memoized per model class.
+    """
+    return tuple(field for field in model._meta.concrete_fields
+                 if getattr(field, 'auto_now', False))
+
+
+def _single_field_lookup(model, get_by):
+    """
+    Check if the lookup finds objects by the value of a single, plain field of
+    the model (i.e. one that can be prefetched with an 'IN' lookup).
+
+    :return: A (field, value) tuple, where the value is converted to the
+        field's Python type, or None if the lookup is not that simple
+    """
+    if len(get_by) != 1:
+        return None
+    (name, value), = get_by.items()
+    field = _get_field(model, name)
+    if field is None or field.is_relation or not field.concrete:
+        return None
+    try:
+        return field, field.to_python(value)
+    except ValidationError:
+        return None
+
+
+def _is_content_object_loaded(mapping):
+    """Whether the mapping's content_object has been loaded already."""
+    descriptor = ExternalKeyMapping.content_object
+    if hasattr(descriptor, 'is_cached'):
+        return descriptor.is_cached(mapping)
+    # Django < 2.0
+    return hasattr(mapping, descriptor.cache_attr)
+
+
+def _unload_content_object(mapping):
+    """Make the mapping load its content_object again when next used."""
+    descriptor = ExternalKeyMapping.content_object
+    if not _is_content_object_loaded(mapping):
+        return
+    if hasattr(descriptor, 'delete_cached_value'):
+        descriptor.delete_cached_value(mapping)
+    else:
+        # Django < 2.0
+        delattr(mapping, descriptor.cache_attr)
+
+
+def _shares_rows(model, other_model):
+    """
+    Whether objects of the two models can be the same database row, i.e. if
+    they are the same model or one inherits from the other.
+    """
+    return issubclass(model, other_model) or issubclass(other_model, model)
+
+
 def set_value_to_remote(object, attribute, value):
     target_attr = getattr(object, attribute)
-    if object._meta.get_field(attribute).one_to_one:
-        if VERSION[0] == 1 and VERSION[1] < 9:
-            target_attr = value
-        else:
-            target_attr.set(value)
+    if _get_field(type(object), attribute).one_to_one:
+        target_attr.set(value)
     else:
         target_attr.add(value)
 
@@ -63,7 +193,15 @@ class UnknownActionType(Exception):
             self.model_name)
 
 class ObjectSelector:
-    OPERATORS = set(['|', '&', '~'])
+    OPERATORS = frozenset('|&~')
+
+    # The number of operands, and the function to combine them, for each of
+    # the operators
+    OPERATIONS = {
+        '|': (2, operator.or_),
+        '&': (2, operator.and_),
+        '~': (1, operator.inv),
+    }
 
     def __init__(self, match_on, available_fields):
         for field_name in match_on:
@@ -77,47 +215,62 @@ class ObjectSelector:
 
         self.match_on = match_on
         self.fields = available_fields
+        self.plan = self.compile(match_on)
 
-    def get_by(self):
-        def build_selector(match):
-            return Q(**{match: self.fields[match]})
+    @classmethod
+    def compile(cls, match_on):
+        """
+        Convert the match_on tokens into the list of steps that get_by()
+        evaluates, so that the tokens are only interpreted once.
 
+        Each step is a (token, arity, function) tuple, where an arity of 0
+        means the token is a field name to build a selector for.
+        """
         # if no operators present, then just AND all of the match_ons
-        if len(self.OPERATORS.intersection(self.match_on)) == 0:
-            match = self.match_on[0]
-            q = build_selector(match)
-            for match in self.match_on[1:]:
-                q = q & build_selector(match)
+        if cls.OPERATORS.isdisjoint(match_on):
+            postfix = list(match_on[:1])
+            for match in match_on[1:]:
+                postfix.extend([match, '&'])
+        else:
+            postfix = match_on
+
+        plan = []
+        for match in postfix:
+            if match in cls.OPERATORS:
+                arity, function = cls.OPERATIONS[match]
+                plan.append((match, arity, function))
+            else:
+                plan.append((match, 0, None))
+        return plan
 
-            return q
+    def key(self):
+        """
+        A hashable value that identifies the selection, i.e. two selectors
+        with the same key select the same objects.
+        """
+        return (tuple(self.match_on),
+                tuple(self.fields[match] for match in self.match_on
+                      if match not in self.OPERATORS))
 
+    def get_by(self):
         # process post-fix operator string
         stack = []
-        for match in self.match_on:
-            if match in self.OPERATORS:
-                if match is '~':
-                    if len(stack) < 1:
-                        raise ValueError('Insufficient operands for operator:{}', match)
-
-                    stack.append(~stack.pop())
-                    continue
+        for match, arity, function in self.plan:
+            if arity == 0:
+                stack.append(Q(**{match: self.fields[match]}))
+                continue
 
-                if len(stack) < 2:
-                    raise ValueError('Insufficient operands for operator:{}', match)
+            if len(stack) < arity:
+                raise ValueError('Insufficient operands for operator:{}', match)
 
-                # remove the operands from the stack in reverse order 
-                # (preserves left-to-right reading)
+            # remove the operands from the stack in reverse order
+            # (preserves left-to-right reading)
+            if arity == 1:
+                stack.append(function(stack.pop()))
+            else:
                 operand2 = stack.pop()
                 operand1 = stack.pop()
-
-                if match == '|':
-                    stack.append(operand1 | operand2)
-                elif match == '&':
-                    stack.append(operand1 & operand2)
-                else:
-                    pass
-            else:
-                stack.append(build_selector(match))
+                stack.append(function(operand1, operand2))
 
         if len(stack) != 1:
             raise ValueError('Insufficient operators, stack:{}', stack)
@@ -133,6 +286,11 @@ class ModelAction:
     for finding the target objects.
     """
     REFERRED_TO_DELIMITER = '=>'
+    # Prefixes for referred to many-to-many fields, to add / remove / set
+    MANY_TO_MANY_ACTION_TYPES = frozenset('+-=')
+
+    # The ActionBatch this action is being executed as part of (if any)
+    batch = None
 
     def __init__(self, model, match_on, fields={}):
         """
@@ -168,6 +326,8 @@ class ModelAction:
 
     def get_object(self):
         """Finds the object that matches the provided matching information"""
+        if self.batch is not None:
+            return self.batch.get_object(self.model, self.match_on)
         return self.model.objects.get(self.match_on.get_by())
 
     def execute(self):
@@ -184,43 +344,62 @@ class ModelAction:
         :param object: the object to update
         :param force (bool): (Optional) Whether the update should only
         affect 'empty' fields. Default: False
-        :return:
+        :return: The names of the (concrete) fields of the object that were
+        set. Many-to-many and reverse relations are not included, as they are
+        written to the database straight away.
         """
+        changed_fields = set()
+
         # we need to support referential attributes, so look for them
         # as we iterate and store them for later
 
         # We store the referential attributes as a dict of dicts, this way
         # filtering against many fields is possible
         referential_attributes = defaultdict(dict)
-        for attribute, value in self.fields.items():
-            if self.REFERRED_TO_DELIMITER in attribute and value != '':
-                ref_attr = attribute.split(self.REFERRED_TO_DELIMITER)
+        fields = self.fields
+        object_dict = object.__dict__
+        for (attribute, ref_attr, current_attribute, nullable,
+             changed_field, dict_key) in self.field_plan(type(object)):
+            value = fields[attribute]
+            if ref_attr is not None and value != '':
                 referential_attributes[ref_attr[0]][ref_attr[1]] = value
             else:
                 if not force:
-                    current_value = getattr(object, attribute, None)
-                    if not (current_value is None or current_value is ''):
+                    current_value = getattr(object, current_attribute, None)
+                    if not (current_value is None or current_value == ''):
                         continue
-                try:
-                    if object._meta.get_field(attribute).null:
-                        value = None if value == '' else value
-                except FieldDoesNotExist:
-                    pass
-                setattr(object, attribute, value)
+                if nullable and value == '':
+                    value = None
+                if dict_key is not None:
+                    object_dict[dict_key] = value
+                else:
+                    setattr(object, attribute, value)
+                if changed_field is not None:
+                    changed_fields.add(changed_field)
 
         for attribute, get_by in referential_attributes.items():
-            try:
-                field = object._meta.get_field(attribute)
-                # For migration advice of the get_field_by_name() call see [1]
-                # [1]: https://docs.djangoproject.com/en/1.9/ref/models/meta/#migrating-old-meta-api
+            # For migration advice of the get_field_by_name() call see [1]
+            # [1]: https://docs.djangoproject.com/en/1.9/ref/models/meta/#migrating-old-meta-api
+            field = _get_field(type(object), attribute)
+            if field is None:
+                logger.warning('Attibute "{}" does not exist on {}[{}]',
+                    attribute,
+                    object.__class__.__name__,
+                    object)
+                continue
 
+            try:
                 if field.related_model:
                     if field.concrete:
                         own_attribute = field.name
+                        # The column value, i.e. without loading the related
+                        # object
+                        current_attribute = field.attname
                         get_current_value = getattr
                         set_value = setattr
                     else:
                         own_attribute = field.get_accessor_name()
+                        current_attribute = own_attribute
                         def get_value_from_remote(object, attribute, default):
                             try:
                                 return getattr(object, attribute).get()
@@ -230,7 +409,9 @@ class ModelAction:
                         set_value = set_value_to_remote
 
                     if not force:
-                        current_value = get_current_value(object, own_attribute, None)
+                        current_value = get_current_value(object,
+                                                          current_attribute,
+                                                          None)
                         if current_value is not None:
                             continue
 
@@ -247,27 +428,27 @@ class ModelAction:
                                         object.__class__.__name__)
                                 get_by_exact[k[1:]] = v
 
-                            if action_type not in '+-=':
+                            if action_type not in self.MANY_TO_MANY_ACTION_TYPES:
                                 raise UnknownActionType(action_type, 
                                     field.verbose_name,
                                     object.__class__.__name__)
 
-                            target = field.related_model.objects.get(**get_by_exact)
+                            target = self.get_related_object(
+                                field.related_model, get_by_exact)
 
-                            if action_type is '+':
+                            if action_type == '+':
                                 getattr(object, own_attribute).add(target)
-                            elif action_type is '-':
+                            elif action_type == '-':
                                 getattr(object, own_attribute).remove(target)
-                            elif action_type is '=':
-                                attr = getattr(object, own_attribute)
-                                # Django 1.9 impl  => getattr(object, own_attribute).set([target])
-                                attr.clear()
-                                for t in set([target]):
-                                    attr.add(t)
+                            elif action_type == '=':
+                                getattr(object, own_attribute).set([target])
 
                         else:
-                            target = field.related_model.objects.get(**get_by)
+                            target = self.get_related_object(
+                                field.related_model, get_by)
                             set_value(object, own_attribute, target)
+                            if field.concrete:
+                                changed_fields.add(field.name)
                             logger.debug(object)
 
                     except ObjectDoesNotExist as e:
@@ -286,11 +467,6 @@ class ModelAction:
                             object.__class__.__name__,
                             object,
                             field.verbose_name)
-            except FieldDoesNotExist as e:
-                logger.warning( 'Attibute "{}" does not exist on {}[{}]',
-                    attribute,
-                    object.__class__.__name__,
-                    object)
 
             except DissimilarActionTypesError as e:
                 logger.warning('{}', e)
@@ -298,6 +474,27 @@ class ModelAction:
             except UnknownActionType as e:
                 logger.warning('{}', e)
 
+        return changed_fields
+
+    def field_plan(self, model):
+        """
+        The parsed attribute names of the action's fields (see _field_plan()).
+        """
+        return _field_plan(model, tuple(self.fields))
+
+    def get_related_object(self, model, get_by):
+        """
+        Finds the object referred to by a referential attribute, using the
+        objects prefetched by the batch (if any) before querying for it.
+        """
+        if self.batch is not None:
+            # The object may be one that the batch is still to insert
+            self.batch.flush_creates_of(model)
+            obj = self.batch.get_related_object(model, get_by)
+            if obj is not None:
+                return obj
+        return model.objects.get(**get_by)
+
 
 class CreateModelAction(ModelAction):
     """
@@ -306,6 +503,9 @@ class CreateModelAction(ModelAction):
     Note, this will not create another object if a matching one is
     found, nor will it update a matched object.
     """
+    # Whether the primary key of the created object is used once the batch
+    # the action is part of has been flushed
+    needs_pk = False
 
     def execute(self):
         try:
@@ -320,7 +520,11 @@ class CreateModelAction(ModelAction):
         obj=self.model()
         # NB: Create uses force to override defaults
         self.update_from_fields(obj, True)
-        obj.save()
+        if self.batch is None or not self.batch.defer_create(
+                obj, self.needs_pk, self.match_on):
+            obj.save()
+            if self.batch is not None:
+                self.batch.object_created(obj)
         return obj
 
     @property
@@ -328,11 +532,71 @@ class CreateModelAction(ModelAction):
         return 'create'
 
 
-class CreateModelWithReferenceAction(CreateModelAction):
+class ReferenceActionMixin:
+    """
+    Behaviour shared by the actions that create or update the
+    ExternalKeyMapping for the object they act upon.
+    """
+
+    def get_mapping(self):
+        """
+        Finds the ExternalKeyMapping for the action's external system and key,
+        or provides a new (unsaved) one if there is not one yet.
+
+        If the action is part of a prepared ActionBatch, the mapping is taken
+        from the batch rather than queried for.
+        """
+        key = (self.external_system.pk, self.external_key)
+        if self.batch is not None and key in self.batch.mappings:
+            mapping = self.batch.mappings[key]
+        else:
+            try:
+                mapping = ExternalKeyMapping.objects.get(
+                    external_system=self.external_system,
+                    external_key=self.external_key)
+            except ExternalKeyMapping.DoesNotExist:
+                mapping = None
+
+        if mapping is None:
+            mapping = ExternalKeyMapping(
+                external_system=self.external_system,
+                external_key=self.external_key)
+        return mapping
+
+    def save_mapping(self, mapping, model_obj):
+        """
+        Points the mapping at the model object and saves it.
+
+        The save is skipped if the mapping already points at the object, and
+        deferred to the batch if the batch is in bulk mode.
+        """
+        key = (self.external_system.pk, self.external_key)
+        content_type = ContentType.objects.get_for_model(self.model)
+        unchanged = (mapping.pk is not None and
+                     mapping.content_type_id == content_type.pk and
+                     mapping.object_id == model_obj.pk)
+
+        mapping.content_type = content_type
+        mapping.content_object = model_obj
+        mapping.object_id = model_obj.id
+
+        if self.batch is not None:
+            self.batch.mappings[key] = mapping
+            self.batch.object_mapped(mapping, model_obj)
+            if self.batch.use_bulk and not unchanged:
+                self.batch.pending_mappings[key] = (mapping, model_obj)
+                return
+
+        if not unchanged:
+            mapping.save()
+
+
+class CreateModelWithReferenceAction(ReferenceActionMixin, CreateModelAction):
     """
     Action to create a model object if it does not exist, and to create or
     update an external reference to the object.
     """
+    needs_pk = True
 
     def __init__(self, external_system, model,
                  external_key, match_on, fields={}):
@@ -354,29 +618,17 @@ class CreateModelWithReferenceAction(CreateModelAction):
         self.external_key=external_key
 
     def execute(self):
-        try:
-            mapping=ExternalKeyMapping.objects.get(
-                external_system=self.external_system,
-                external_key=self.external_key)
-        except ExternalKeyMapping.DoesNotExist:
-            mapping=ExternalKeyMapping(
-                external_system=self.external_system,
-                external_key=self.external_key)
+        mapping=self.get_mapping()
 
         model_obj=mapping.content_object
         if model_obj is None:
             model_obj=super(CreateModelWithReferenceAction, self).execute()
 
         if model_obj:
-            mapping.content_type=ContentType.objects.get_for_model(
-                self.model)
-            mapping.content_object=model_obj
-            mapping.object_id=model_obj.id
-            mapping.save()
+            self.save_mapping(mapping, model_obj)
         return model_obj
 
 
-from django.db import IntegrityError, transaction
 class UpdateModelAction(ModelAction):
     """
     Action to update the fields of a model object, but not create an
@@ -405,14 +657,44 @@ class UpdateModelAction(ModelAction):
     def type(self):
         return 'update'
 
-    def execute(self):
-        try:
-            obj=self.get_object()
-            self.update_from_fields(obj, self.force_update)
+    def save_object(self, obj, changed_fields):
+        """
+        Saves the updated object, or defers the save to the batch if the batch
+        is in bulk mode.
+        """
+        if self.batch is not None:
+            if obj.pk is None:
+                # The object is still to be inserted by the batch, which will
+                # write the updated fields then
+                return
+            self.batch.object_updated(obj, changed_fields)
+            if self.batch.defer_update(obj, changed_fields):
+                return
 
-            with transaction.atomic():
+        try:
+            if self.batch is not None:
+                db = self.batch.db_for_write(self.model)
+            else:
+                db = router.db_for_write(self.model)
+            if transaction.get_connection(db).in_atomic_block:
+                # Use a savepoint, so that an integrity error does not break
+                # the surrounding transaction
+                with transaction.atomic(using=db):
+                    obj.save()
+            else:
+                # The save is atomic by itself
                 obj.save()
+        except IntegrityError:
+            if self.batch is not None:
+                # The object no longer matches the database
+                self.batch.discard_objects(self.model)
+            raise
 
+    def execute(self):
+        try:
+            obj=self.get_object()
+            changed_fields=self.update_from_fields(obj, self.force_update)
+            self.save_object(obj, changed_fields)
             return obj
         except ObjectDoesNotExist:
             return None
@@ -423,7 +705,7 @@ class UpdateModelAction(ModelAction):
             logger.warning('Integrity issue - {} Error:{}', str(self), e)
             return None
 
-class UpdateModelWithReferenceAction(UpdateModelAction):
+class UpdateModelWithReferenceAction(ReferenceActionMixin, UpdateModelAction):
     """
     Action to create a model object if it does not exist, and to create or
     update an external reference to the object.
@@ -449,23 +731,56 @@ class UpdateModelWithReferenceAction(UpdateModelAction):
         self.external_system=external_system
         self.external_key=external_key
 
-    def execute(self):
-        try:
-            mapping=ExternalKeyMapping.objects.get(
-                external_system=self.external_system,
-                external_key=self.external_key)
-        except ExternalKeyMapping.DoesNotExist:
-            mapping=ExternalKeyMapping(
-                external_system=self.external_system,
-                external_key=self.external_key)
+    def get_linked_and_matched_objects(self, mapping):
+        """
+        Finds the object the mapping links to and the object that matches the
+        provided matching information.
+
+        If the mapping links to an object of the action's model that has not
+        been loaded yet, both objects are fetched with a single query.
+
+        :return: A (linked object, matched object) tuple, where either can be
+            None
+        """
+        content_type=ContentType.objects.get_for_model(self.model)
+        if (mapping.object_id is None or
+                mapping.content_type_id != content_type.pk or
+                _is_content_object_loaded(mapping)):
+            linked_object=mapping.content_object
+            try:
+                matched_object=self.get_object()
+            except ObjectDoesNotExist:
+                matched_object=None
+            return linked_object, matched_object
+
+        get_by=self.match_on.get_by()
+        objs=self.model.objects.filter(
+            Q(pk=mapping.object_id) | get_by).annotate(
+                nsync_matched=Case(When(get_by, then=Value(True)),
+                                   default=Value(False),
+                                   output_field=BooleanField()))
+
+        linked_object=None
+        matched_objects=[]
+        for obj in objs:
+            if obj.pk == mapping.object_id:
+                linked_object=obj
+            if obj.nsync_matched:
+                matched_objects.append(obj)
+
+        if len(matched_objects) > 1:
+            raise self.model.MultipleObjectsReturned(
+                'get() returned more than one {} -- it returned {}!'.format(
+                    self.model._meta.object_name, len(matched_objects)))
+        return linked_object, (matched_objects[0] if matched_objects
+                               else None)
 
-        linked_object=mapping.content_object
+    def execute(self):
+        mapping=self.get_mapping()
 
-        matched_object=None
         try:
-            matched_object=self.get_object()
-        except ObjectDoesNotExist:
-            pass
+            linked_object, matched_object=self.get_linked_and_matched_objects(
+                mapping)
         except MultipleObjectsReturned as e:
             logger.warning('Mulitple objects found - {} Error:{}', str(self), e)
             return None
@@ -474,7 +789,13 @@ class UpdateModelWithReferenceAction(UpdateModelAction):
         # get rid of the matched one
         if matched_object and linked_object and (matched_object != 
                                                  linked_object):
+            if matched_object.pk is None:
+                # The object is still to be inserted by the batch
+                self.batch.flush()
+                matched_object=self.get_object()
             matched_object.delete()
+            if self.batch is not None:
+                self.batch.discard_objects()
 
         # Choose the most appropriate object to update
         if linked_object:
@@ -486,20 +807,19 @@ class UpdateModelWithReferenceAction(UpdateModelAction):
             return None
 
         if model_obj:
-            self.update_from_fields(model_obj, self.force_update)
-            try:
-                with transaction.atomic():
-                    model_obj.save()
-            except IntegrityError as e:
-                logger.warning('Integrity issue - {} Error:{}', str(self), e)
-                return None
+            changed_fields=self.update_from_fields(model_obj,
+                                                   self.force_update)
+            # An object that is still to be inserted by the batch will be
+            # written with the updated fields then
+            if model_obj.pk is not None:
+                try:
+                    self.save_object(model_obj, changed_fields)
+                except IntegrityError as e:
+                    logger.warning('Integrity issue - {} Error:{}', str(self), e)
+                    return None
 
         if model_obj:
-            mapping.content_type=ContentType.objects.get_for_model(
-                self.model)
-            mapping.content_object=model_obj
-            mapping.object_id=model_obj.id
-            mapping.save()
+            self.save_mapping(mapping, model_obj)
 
         return model_obj
 
@@ -523,26 +843,42 @@ class DeleteIfOnlyReferenceModelAction(ModelAction):
         return self.delete_action.type
 
     def execute(self):
+        if self.batch is not None:
+            key=(self.external_system.pk, self.external_key)
+            if key in self.batch.mappings and self.batch.mappings[key] is None:
+                # The batch knows that there is no key mapping for 'this'
+                # external key, so there is nothing to check
+                return
+            if not self.batch.defers_deletes:
+                # The mapping to check may not have been written yet
+                self.batch.flush()
+
         try:
             obj=self.delete_action.get_object()
-
-            key_mapping=ExternalKeyMapping.objects.get(
-                object_id=obj.id,
-                content_type=ContentType.objects.get_for_model(
-                    self.delete_action.model),
-                external_key=self.external_key)
-
-            if key_mapping.external_system == self.external_system:
-                self.delete_action.execute()
-            else:
-                # The key mapping is not 'this' systems key mapping
-                pass
         except MultipleObjectsReturned:
-            # There are multiple key mappings or multiple target objects, we shouldn't delete the object
+            # There are multiple target objects, we shouldn't delete the object
             return
         except ObjectDoesNotExist:
             return
 
+        if self.batch is not None and self.batch.defer_reference_check(
+                obj, self.external_system, self.external_key):
+            return
+
+        # Fetching two is enough to know if there are other key mappings
+        key_mappings=list(ExternalKeyMapping.objects.filter(
+            object_id=obj.id,
+            content_type=ContentType.objects.get_for_model(
+                self.delete_action.model)).values_list(
+                    'external_system_id', 'external_key')[:2])
+
+        if key_mappings == [(self.external_system.pk, self.external_key)]:
+            self.delete_action.execute()
+        else:
+            # There is no key mapping, it is not 'this' systems key mapping
+            # or there are others
+            pass
+
 
 class DeleteModelAction(ModelAction):
 
@@ -554,7 +890,17 @@ class DeleteModelAction(ModelAction):
         """Forcibly delete any objects found by the
         ModelAction.get_object() method."""
         try:
-            self.get_object().delete()
+            obj = self.get_object()
+            if obj.pk is None:
+                # The object is still to be inserted by the batch
+                self.batch.flush()
+                obj = self.get_object()
+            if self.batch is not None and self.batch.defer_delete(obj):
+                return
+            obj.delete()
+            if self.batch is not None:
+                # The delete may have cascaded to objects of other models
+                self.batch.discard_objects()
         except ObjectDoesNotExist:
             pass
         except MultipleObjectsReturned as e:
@@ -567,6 +913,9 @@ class DeleteExternalReferenceAction:
     A model action to remove the ExternalKeyMapping object for a model object.
     """
 
+    # The ActionBatch this action is being executed as part of (if any)
+    batch = None
+
     def __init__(self, external_system, external_key):
         self.external_system=external_system
         self.external_key=external_key
@@ -581,9 +930,628 @@ class DeleteExternalReferenceAction:
         system and external key.
         :return: Nothing
         """
+        if self.batch is not None:
+            if self.batch.defer_reference_delete(self.external_system,
+                                                 self.external_key):
+                return
+            self.batch.flush()
+
         ExternalKeyMapping.objects.filter(
             external_system=self.external_system,
             external_key=self.external_key).delete()
+        if self.batch is not None:
+            self.batch.mappings[
+                (self.external_system.pk, self.external_key)] = None
+
+
+class ActionBatch:
+    """
+    A group of actions that are executed together.
+
+    Preparing the batch attaches the actions to it and resolves, in as few
+    queries as possible, the lookups that the actions would otherwise make
+    one at a time while executing. These are:
+
+    - The ExternalKeyMapping of each of the 'with reference' and reference
+      delete actions, which are fetched with one query per external system,
+      and the objects they map to, which are fetched with one query per model
+    - The objects referred to by referential attributes that select the
+      object by a single field (e.g. 'owner=>email'), which are fetched with
+      one query per related model and field
+
+    Lookups that miss the prefetched objects are still made one at a time,
+    so objects created while executing the batch are found as before.
+
+    The batch also remembers the objects that the actions' get_object() finds,
+    so that actions matching the same object only query for it once. Creating
+    an object of a model forgets the objects found for that model, as their
+    lookups may now find the new object as well.
+
+    In bulk mode the actions also defer some of their writes to the batch,
+    which performs them together when it is flushed:
+
+    - New model objects are inserted with bulk_create(), one query per model
+      (except for multi-table inherited models, which bulk_create() does not
+      support)
+    - New ExternalKeyMapping objects are inserted with bulk_create()
+    - Updated model objects are written with bulk_update(), one query per
+      model, for just the fields that the actions set
+    - ExternalKeyMapping objects are deleted with one query per external
+      system
+    - If all of the batch's actions are deletes, model objects are deleted
+      with one QuerySet.delete() per model (which still cascades and sends
+      the delete signals), and the checks of the DeleteIfOnlyReference
+      actions are made with one query per model. Otherwise those actions
+      flush the batch and check their object one at a time.
+
+    Objects that are queued to be inserted are found by later actions that
+    match on the same fields and values (so duplicate rows do not insert
+    duplicate objects). Referential attributes that refer to a model with
+    objects queued to be inserted flush the batch first, so that they find
+    them. Other lookups do not find them until the batch is flushed.
+    """
+    # The maximum number of keys to include in a single 'IN' lookup
+    LOOKUP_CHUNK_SIZE = 500
+    # The maximum number of objects to write in a single bulk query, unless
+    # overridden by the NSYNC_BULK_BATCH_SIZE setting
+    BULK_BATCH_SIZE = 500
+    # The maximum number of parameters in a single bulk query (PostgreSQL's
+    # limit; Django already keeps to the lower limits of other databases)
+    MAX_QUERY_PARAMS = 32767
+
+    def __init__(self, actions, use_bulk=False):
+        """
+        Create a batch of actions.
+
+        :param actions: The list of actions that will be executed
+        :param use_bulk: (Optional) Whether the actions should defer their
+            writes to the batch. Default: False
+        :return: A new (unprepared) batch
+        """
+        self.actions = actions
+        self.use_bulk = use_bulk
+        self.batch_size = (getattr(settings, 'NSYNC_BULK_BATCH_SIZE', None) or
+                           self.BULK_BATCH_SIZE)
+        # model -> list of objects to insert
+        self.pending_creates = defaultdict(list)
+        # model -> {pk: (object to update, names of the fields to write)}
+        self.pending_updates = defaultdict(dict)
+        # model -> pks of the objects to delete
+        self.pending_deletes = defaultdict(set)
+        # (object, external system pk, external key) of the objects to
+        # delete if the key's mapping is the only mapping to them
+        self.pending_reference_checks = []
+        # Deleting later is only safe if no other kind of action could see
+        # the objects in the meantime
+        self.defers_deletes = use_bulk and all(
+            getattr(action, 'type', None) == 'delete' for action in actions)
+        # (external system pk, external key) -> ExternalKeyMapping or None
+        self.mappings = {}
+        # (external system pk, external key) -> (mapping, model object)
+        self.pending_mappings = {}
+        # (model, ObjectSelector.key()) -> object queued to be inserted
+        self.pending_objects = {}
+        # external system pk -> external keys of the mappings to delete
+        self.pending_reference_deletes = defaultdict(set)
+        # (related model, field name) -> {field value: object}
+        self.related_objects = {}
+        # (model, ObjectSelector.key()) -> object
+        self.objects = {}
+        # model -> {pk: mapping whose loaded content_object has the pk}
+        self.mapped_objects = defaultdict(dict)
+        # model -> alias of the database to write the model's objects to
+        self.write_dbs = {}
+
+    def prepare(self):
+        """
+        Attach the actions to the batch and prefetch what they will need.
+
+        :return: The batch
+        """
+        external_keys = defaultdict(set)
+        related_values = defaultdict(set)
+        for action in self.actions:
+            if isinstance(action, DeleteIfOnlyReferenceModelAction):
+                action.delete_action.batch = self
+            if isinstance(action, (ModelAction,
+                                   DeleteExternalReferenceAction)):
+                action.batch = self
+            if isinstance(action, (ReferenceActionMixin,
+                                   DeleteIfOnlyReferenceModelAction,
+                                   DeleteExternalReferenceAction)):
+                external_keys[action.external_system].add(action.external_key)
+            if isinstance(action, (CreateModelAction, UpdateModelAction)):
+                for model, field, value in self.related_lookups(action):
+                    related_values[(model, field)].add(value)
+
+        for external_system, keys in external_keys.items():
+            self.prefetch_mappings(external_system, list(keys))
+        for (model, field), values in related_values.items():
+            self.prefetch_related_objects(model, field, list(values))
+        return self
+
+    @staticmethod
+    def related_lookups(action):
+        """
+        Find the lookups of the action's referential attributes that can be
+        prefetched.
+
+        :return: A list of (related model, field, value) tuples
+        """
+        referential_attributes = defaultdict(dict)
+        for attribute, ref_attr, *_ in action.field_plan(action.model):
+            value = action.fields[attribute]
+            if ref_attr is not None and value != '':
+                referential_attributes[ref_attr[0]][ref_attr[1]] = value
+
+        lookups = []
+        for attribute, get_by in referential_attributes.items():
+            field = _get_field(action.model, attribute)
+            if field is None or not field.related_model:
+                continue
+            if field.many_to_many:
+                # Strip the action type prefixes
+                get_by = {k[1:]: v for k, v in get_by.items()}
+            lookup = _single_field_lookup(field.related_model, get_by)
+            if lookup is not None:
+                lookups.append((field.related_model,) + lookup)
+        return lookups
+
+    def prefetch_mappings(self, external_system, keys):
+        """
+        Fetch the mappings for the external system and keys, recording the
+        keys that do not have a mapping as well.
+        """
+        for key in keys:
+            self.mappings[(external_system.pk, key)] = None
+
+        for i in range(0, len(keys), self.LOOKUP_CHUNK_SIZE):
+            mappings = ExternalKeyMapping.objects.filter(
+                external_system=external_system,
+                external_key__in=keys[i:i + self.LOOKUP_CHUNK_SIZE]
+            ).prefetch_related('content_object')
+            for mapping in mappings:
+                self.mappings[
+                    (external_system.pk, mapping.external_key)] = mapping
+                if mapping.content_object is not None:
+                    self.object_mapped(mapping, mapping.content_object)
+
+    def object_mapped(self, mapping, obj):
+        """
+        Record that the mapping's loaded content_object is the object, so
+        that it can be unloaded if the object becomes stale.
+        """
+        if obj.pk is not None:
+            self.mapped_objects[type(obj)][obj.pk] = mapping
+
+    def prefetch_related_objects(self, model, field, values):
+        """
+        Fetch the objects of the model that have one of the values for the
+        field. Values that are shared by several objects are left out, so that
+        looking them up reports the duplicates as before.
+        """
+        found = {}
+        duplicated = set()
+        for i in range(0, len(values), self.LOOKUP_CHUNK_SIZE):
+            objs = model.objects.filter(**{
+                '{}__in'.format(field.name):
+                    values[i:i + self.LOOKUP_CHUNK_SIZE]})
+            for obj in objs:
+                value = getattr(obj, field.attname)
+                if value in found:
+                    duplicated.add(value)
+                found[value] = obj
+
+        for value in duplicated:
+            del found[value]
+        self.related_objects[(model, field.name)] = found
+
+    def get_related_object(self, model, get_by):
+        """
+        Find a prefetched object for the lookup.
+
+        :return: The object, or None if it was not prefetched
+        """
+        if not self.related_objects:
+            return None
+        lookup = _single_field_lookup(model, get_by)
+        if lookup is None:
+            return None
+        field, value = lookup
+        return self.related_objects.get((model, field.name), {}).get(value)
+
+    def get_object(self, model, selector):
+        """
+        Find the object of the model that the ObjectSelector selects, querying
+        for it only if it has not been found (or queued to be inserted)
+        before.
+        """
+        key = (model, selector.key())
+        obj = self.pending_objects.get(key)
+        if obj is None:
+            obj = self.objects.get(key)
+        if obj is None:
+            obj = model.objects.get(selector.get_by())
+            self.objects[key] = obj
+        return obj
+
+    def object_created(self, obj):
+        """
+        Forget the found and prefetched objects of the object's model, as the
+        lookups that found them may now find the new object as well.
+        """
+        model = type(obj)
+        for cache in [self.related_objects, self.objects]:
+            for key in list(cache):
+                if _shares_rows(model, key[0]):
+                    del cache[key]
+
+    def object_updated(self, obj, fields):
+        """
+        Forget the found and prefetched objects that updating the object may
+        have made stale. These are the other instances of the model that were
+        found, which would overwrite the update if saved, and any objects that
+        were found by one of the updated fields.
+
+        :param obj: The object being updated
+        :param fields: The names of the fields being updated
+        """
+        model = type(obj)
+        for key in list(self.related_objects):
+            if _shares_rows(model, key[0]) and key[1] in fields:
+                del self.related_objects[key]
+        for key, found in list(self.objects.items()):
+            if _shares_rows(model, key[0]) and (
+                    found is not obj or not fields.isdisjoint(key[1][0])):
+                del self.objects[key]
+        for mapped_model, mappings in self.mapped_objects.items():
+            mapping = mappings.get(obj.pk)
+            if (mapping is not None and _shares_rows(model, mapped_model) and
+                    mapping.content_object is not obj):
+                _unload_content_object(mapping)
+                del mappings[obj.pk]
+
+    def discard_objects(self, model=None):
+        """
+        Forget the found and prefetched objects of the model (or of all
+        models), as they may no longer match the database.
+        """
+        for cache in [self.related_objects, self.objects]:
+            for key in list(cache):
+                if model is None or _shares_rows(model, key[0]):
+                    del cache[key]
+        for mapped_model in list(self.mapped_objects):
+            if model is None or _shares_rows(model, mapped_model):
+                for mapping in self.mapped_objects.pop(mapped_model).values():
+                    _unload_content_object(mapping)
+
+    def defer_create(self, obj, needs_pk=False, selector=None):
+        """
+        Queue the (unsaved) object to be inserted when the batch is flushed.
+
+        :param obj: The model object to insert
+        :param needs_pk: (Optional) Whether the object's primary key must be
+            set by the insert. Default: False
+        :param selector: (Optional) The ObjectSelector that the object was
+            not found by; later lookups with the same selection find the
+            queued object rather than inserting another one. Default: None
+        :return: Whether the object was queued; if not, it should be saved by
+            the caller
+        """
+        model = type(obj)
+        if not self.use_bulk or model._meta.parents:
+            return False
+
+        if needs_pk:
+            features = connections[self.db_for_write(model)].features
+            if not getattr(features, 'can_return_rows_from_bulk_insert',
+                           getattr(features, 'can_return_ids_from_bulk_insert',
+                                   False)):
+                return False
+
+        self.pending_creates[model].append(obj)
+        if selector is not None:
+            self.pending_objects[(model, selector.key())] = obj
+        return True
+
+    def defer_update(self, obj, fields):
+        """
+        Queue the fields of the (saved) object to be written when the batch is
+        flushed.
+
+        If the same database row has already been queued through another
+        instance, the values of the fields are copied onto that instance.
+
+        :param obj: The model object to update
+        :param fields: The names of the fields to write
+        :return: Whether the update was queued; if not, the object should be
+            saved by the caller
+        """
+        if not self.use_bulk:
+            return False
+
+        model = type(obj)
+        pending = self.pending_updates[model]
+        if obj.pk not in pending:
+            pending[obj.pk] = (obj, set(fields))
+            return True
+
+        queued, queued_fields = pending[obj.pk]
+        if queued is not obj:
+            for name in fields:
+                attname = _get_field(model, name).attname
+                setattr(queued, attname, getattr(obj, attname))
+        queued_fields.update(fields)
+        return True
+
+    def defer_delete(self, obj):
+        """
+        Queue the model object to be deleted when the batch is flushed.
+
+        :return: Whether the delete was queued; if not, it should be performed
+            by the caller
+        """
+        if not self.defers_deletes:
+            return False
+
+        self.pending_deletes[type(obj)].add(obj.pk)
+        return True
+
+    def defer_reference_check(self, obj, external_system, external_key):
+        """
+        Queue the object to be deleted when the batch is flushed, if the
+        mapping for the external system and key is then the only mapping to
+        it (once the batch's mapping deletes are taken into account).
+
+        :return: Whether the check was queued; if not, it should be performed
+            by the caller
+        """
+        if not self.defers_deletes:
+            return False
+
+        self.pending_reference_checks.append(
+            (obj, external_system.pk, external_key))
+        return True
+
+    def defer_reference_delete(self, external_system, external_key):
+        """
+        Queue the ExternalKeyMapping for the external system and key to be
+        deleted when the batch is flushed.
+
+        :return: Whether the delete was queued; if not, it should be performed
+            by the caller
+        """
+        if not self.use_bulk:
+            return False
+
+        key = (external_system.pk, external_key)
+        pending = self.pending_mappings.pop(key, None)
+        if pending is not None:
+            saved = pending[0].pk is not None
+        else:
+            # Unless the batch knows there is no mapping
+            saved = self.mappings.get(key, True) is not None
+        if saved:
+            self.pending_reference_deletes[external_system.pk].add(
+                external_key)
+        self.mappings[key] = None
+        return True
+
+    def flush(self):
+        """
+        Perform the writes that the actions have deferred to the batch.
+
+        It is safe to flush a batch more than once, e.g. part way through
+        executing its actions.
+
+        The writes are committed together, rather than one at a time when
+        not already in a transaction. No savepoint is made if already in a
+        transaction.
+        """
+        if not (self.pending_reference_checks or
+                self.pending_reference_deletes or self.pending_deletes or
+                self.pending_creates or self.pending_updates or
+                self.pending_mappings):
+            # Nothing to write, so no need for a transaction either
+            return
+
+        with transaction.atomic(using=self.db_for_write(ExternalKeyMapping),
+                                savepoint=False):
+            # The checks need the mappings that are about to be deleted
+            self.flush_reference_checks()
+            self.flush_reference_deletes()
+            self.flush_deletes()
+            self.flush_creates()
+            # The mappings of objects whose update fails are not written
+            self.flush_updates()
+            self.flush_mappings()
+
+    def flush_reference_checks(self):
+        if not self.pending_reference_checks:
+            return
+
+        pks_by_model = defaultdict(set)
+        for obj, _, _ in self.pending_reference_checks:
+            pks_by_model[type(obj)].add(obj.pk)
+        # (model, object pk) -> (external system pk, external key) of each of
+        # the object's mappings
+        object_mappings = defaultdict(set)
+        for model, pks in pks_by_model.items():
+            pks = list(pks)
+            for i in range(0, len(pks), self.LOOKUP_CHUNK_SIZE):
+                mappings = ExternalKeyMapping.objects.filter(
+                    content_type=ContentType.objects.get_for_model(model),
+                    object_id__in=pks[i:i + self.LOOKUP_CHUNK_SIZE]
+                ).values_list('object_id', 'external_system_id',
+                              'external_key')
+                for object_id, external_system_id, external_key in mappings:
+                    object_mappings[(model, object_id)].add(
+                        (external_system_id, external_key))
+
+        deleted = {(external_system_id, external_key)
+                   for external_system_id, keys in
+                   self.pending_reference_deletes.items()
+                   for external_key in keys}
+        for obj, external_system_id, external_key in \
+                self.pending_reference_checks:
+            key = (external_system_id, external_key)
+            # The mappings that are left once the other keys' mappings are
+            # deleted
+            remaining = (object_mappings[(type(obj), obj.pk)] -
+                         (deleted - {key}))
+            if remaining == {key}:
+                self.pending_deletes[type(obj)].add(obj.pk)
+        self.pending_reference_checks.clear()
+
+    def flush_reference_deletes(self):
+        for external_system_id, keys in self.pending_reference_deletes.items():
+            keys = list(keys)
+            for i in range(0, len(keys), self.LOOKUP_CHUNK_SIZE):
+                ExternalKeyMapping.objects.filter(
+                    external_system_id=external_system_id,
+                    external_key__in=keys[i:i + self.LOOKUP_CHUNK_SIZE]
+                ).delete()
+        self.pending_reference_deletes.clear()
+
+    def db_for_write(self, model):
+        """
+        router.db_for_write() for the model, resolved once per batch rather
+        than for every action or query.
+        """
+        db = self.write_dbs.get(model)
+        if db is None:
+            db = self.write_dbs[model] = router.db_for_write(model)
+        return db
+
+    def bulk_batch_size(self, params_per_object):
+        """
+        The number of objects to write in each bulk query, when each object
+        needs params_per_object query parameters.
+        """
+        return max(1, min(self.batch_size,
+                          self.MAX_QUERY_PARAMS // max(1, params_per_object)))
+
+    def flush_deletes(self):
+        if not self.pending_deletes:
+            return
+
+        for model, pks in self.pending_deletes.items():
+            pks = list(pks)
+            for i in range(0, len(pks), self.LOOKUP_CHUNK_SIZE):
+                model.objects.using(self.db_for_write(model)).filter(
+                    pk__in=pks[i:i + self.LOOKUP_CHUNK_SIZE]).delete()
+        self.pending_deletes.clear()
+        # The deletes may have cascaded to objects of other models
+        self.discard_objects()
+
+    def flush_creates_of(self, model):
+        """
+        Flush the batch if objects of the model are queued to be inserted, so
+        that looking up objects of the model finds them.
+        """
+        if any(_shares_rows(model, pending)
+               for pending in self.pending_creates):
+            self.flush()
+
+    def flush_creates(self):
+        for model, objs in self.pending_creates.items():
+            batch_size = self.bulk_batch_size(
+                len(model._meta.concrete_fields))
+            model.objects.using(self.db_for_write(model)).bulk_create(
+                objs, batch_size=batch_size)
+            self.object_created(objs[0])
+        self.pending_creates.clear()
+
+        for key, obj in self.pending_objects.items():
+            if obj.pk is not None:
+                # The object can be found without querying for it
+                self.objects[key] = obj
+        self.pending_objects.clear()
+
+    def flush_updates(self):
+        for model, pending in self.pending_updates.items():
+            objs = [obj for obj, _ in pending.values()]
+            fields = set()
+            for _, names in pending.values():
+                fields.update(names)
+            if not fields:
+                continue
+
+            # bulk_update() does not call the fields' pre_save(), so set the
+            # auto_now fields as save() would have
+            auto_now_fields = _auto_now_fields(model)
+            for field in auto_now_fields:
+                for obj in objs:
+                    field.pre_save(obj, False)
+                fields.add(field.name)
+
+            self.write_updates(model, objs, sorted(fields))
+        self.pending_updates.clear()
+
+    def write_updates(self, model, objs, fields):
+        """
+        Write the fields of the objects in bulk.
+
+        If that fails with an integrity error, the objects are split in half
+        and each half is written again, so that (as outside of bulk mode) only
+        the objects that cannot be written are skipped and logged, rather
+        than the whole batch.
+        """
+        db = self.db_for_write(model)
+        try:
+            # A savepoint, so that an error does not break the transaction
+            with transaction.atomic(using=db):
+                if hasattr(model.objects, 'bulk_update'):
+                    # Each field is written with a 'WHEN pk THEN value' per
+                    # object
+                    batch_size = self.bulk_batch_size(2 * len(fields) + 1)
+                    model.objects.using(db).bulk_update(
+                        objs, fields, batch_size=batch_size)
+                else:
+                    # Django < 2.2
+                    for obj in objs:
+                        obj.save(using=db, update_fields=fields)
+        except IntegrityError as e:
+            if len(objs) > 1:
+                middle = len(objs) // 2
+                self.write_updates(model, objs[:middle], fields)
+                self.write_updates(model, objs[middle:], fields)
+                return
+
+            logger.warning('Integrity issue - {} Error:{}', objs[0], e)
+            # As outside of bulk mode, the object is not mapped either
+            for key, (_, model_obj) in list(self.pending_mappings.items()):
+                if (_shares_rows(model, type(model_obj)) and
+                        model_obj.pk == objs[0].pk):
+                    del self.pending_mappings[key]
+                    # The mapping must be fetched again if it is needed
+                    self.mappings.pop(key, None)
+            # The object no longer matches the database
+            self.discard_objects(model)
+
+    def flush_mappings(self):
+        new_mappings = []
+        for key, (mapping, model_obj) in self.pending_mappings.items():
+            mapping.object_id = model_obj.pk
+            if mapping.pk is None:
+                new_mappings.append((key, mapping))
+            else:
+                mapping.save(update_fields=['content_type', 'object_id'])
+        self.pending_mappings.clear()
+
+        if not new_mappings:
+            return
+
+        ExternalKeyMapping.objects.using(
+            self.db_for_write(ExternalKeyMapping)).bulk_create(
+            [mapping for _, mapping in new_mappings],
+            batch_size=self.bulk_batch_size(
+                len(ExternalKeyMapping._meta.concrete_fields)))
+        for key, mapping in new_mappings:
+            if mapping.pk is None:
+                # The database did not return the primary key, so the
+                # mapping must be fetched again if it is needed
+                del self.mappings[key]
 
 
 class ActionFactory:
@@ -649,6 +1617,8 @@ class ActionFactory:
         """
         self.model=model
         self.external_system=external_system
+        # (create, update, delete, force, mappable) -> action builders
+        self.builders={}
 
     def is_externally_mappable(self, external_key):
         """
@@ -666,7 +1636,8 @@ class ActionFactory:
         if not isinstance(external_key, str):
             return False
 
-        return external_key.strip() is not ''
+        # i.e. not blank, without building a stripped copy of the key
+        return bool(external_key) and not external_key.isspace()
 
     def build(self, sync_actions, match_on, external_system_key,
               fields):
@@ -682,48 +1653,76 @@ class ActionFactory:
         :param fields:
         :return:
         """
-        actions=[]
-
-        if sync_actions.is_impotent():
-            actions.append(ModelAction(self.model, match_on, fields))
-
-        if sync_actions.delete:
-            action=DeleteModelAction(self.model, match_on, fields)
-            if self.is_externally_mappable(external_system_key):
-                if not sync_actions.force:
-                    action=DeleteIfOnlyReferenceModelAction(
-                        self.external_system, external_system_key, action)
-                actions.append(action)
-                actions.append(DeleteExternalReferenceAction(
-                    self.external_system, external_system_key))
-            elif sync_actions.force:
-                actions.append(action)
-
-        if sync_actions.create:
-            if self.is_externally_mappable(external_system_key):
-                action=CreateModelWithReferenceAction(self.external_system,
-                                                        self.model,
-                                                        external_system_key,
-                                                        match_on,
-                                                        fields)
+        key=(sync_actions.create, sync_actions.update, sync_actions.delete,
+             sync_actions.force,
+             self.is_externally_mappable(external_system_key))
+        builders=self.builders.get(key)
+        if builders is None:
+            builders=self.builders[key]=self.compile_builders(*key)
+
+        return [builder(match_on, external_system_key, fields)
+                for builder in builders]
+
+    def compile_builders(self, create, update, delete, force, mappable):
+        """
+        Work out which actions build() should produce for the combination of
+        action flags and whether the external key is mappable.
+
+        This is only done once per combination, as the rows of a file tend to
+        use very few of them.
+
+        :return: A list of functions, each of which builds one of the actions
+            from the match_on, external key and fields of a row
+        """
+        model=self.model
+        external_system=self.external_system
+        # Rows without any actions do not need any (do-nothing) actions
+        builders=[]
+
+        if delete:
+            if mappable:
+                if force:
+                    builders.append(
+                        lambda match_on, key, fields: DeleteModelAction(
+                            model, match_on, fields))
+                else:
+                    builders.append(
+                        lambda match_on, key, fields:
+                            DeleteIfOnlyReferenceModelAction(
+                                external_system, key,
+                                DeleteModelAction(model, match_on, fields)))
+                builders.append(
+                    lambda match_on, key, fields:
+                        DeleteExternalReferenceAction(external_system, key))
+            elif force:
+                builders.append(
+                    lambda match_on, key, fields: DeleteModelAction(
+                        model, match_on, fields))
+
+        if create:
+            if mappable:
+                builders.append(
+                    lambda match_on, key, fields:
+                        CreateModelWithReferenceAction(
+                            external_system, model, key, match_on, fields))
             else:
-                action=CreateModelAction(self.model, match_on, fields)
-            actions.append(action)
-        if sync_actions.update:
-            if self.is_externally_mappable(external_system_key):
-                action=UpdateModelWithReferenceAction(self.external_system,
-                                                        self.model,
-                                                        external_system_key,
-                                                        match_on,
-                                                        fields,
-                                                        sync_actions.force)
+                builders.append(
+                    lambda match_on, key, fields: CreateModelAction(
+                        model, match_on, fields))
+
+        if update:
+            if mappable:
+                builders.append(
+                    lambda match_on, key, fields:
+                        UpdateModelWithReferenceAction(
+                            external_system, model, key, match_on, fields,
+                            force))
             else:
-                action=UpdateModelAction(self.model, match_on,
-                                           fields, sync_actions.force)
-
-            actions.append(action)
+                builders.append(
+                    lambda match_on, key, fields: UpdateModelAction(
+                        model, match_on, fields, force))
 
-        return actions
+        return builders
 
 
 class SyncActions:
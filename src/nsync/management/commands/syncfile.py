@@ -1,9 +1,18 @@
 from django.core.management.base import BaseCommand, CommandError
+import contextlib
 import os
 import csv
 
-from .utils import ExternalSystemHelper, ModelFinder, CsvActionFactory
-from nsync.policies import BasicSyncPolicy, TransactionSyncPolicy
+from .utils import (
+    READ_BUFFER_SIZE,
+    ExternalSystemHelper,
+    ModelFinder,
+    CsvActionFactory,
+    build_policy,
+    iterate_in_background,
+    model_signals_disconnected,
+    positive_int,
+    str_to_bool)
 
 
 class Command(BaseCommand):
@@ -29,15 +38,33 @@ class Command(BaseCommand):
         # Optional
         parser.add_argument(
             '--create_external_system',
-            type=bool,
+            type=str_to_bool,
             default=True,
             help='The name of the external system to use for storing '
                  'sync information in relation to')
         parser.add_argument(
             '--as_transaction',
-            type=bool,
+            type=str_to_bool,
             default=True,
             help='Wrap all of the actions in a DB transaction Default:True')
+        parser.add_argument(
+            '--use_bulk',
+            type=str_to_bool,
+            default=False,
+            help='Write the changes to the database in bulk where possible. '
+                 'Default:False')
+        parser.add_argument(
+            '--chunk_size',
+            type=positive_int,
+            default=None,
+            help='The number of actions to prepare and write together. '
+                 'Default: All of them')
+        parser.add_argument(
+            '--disable_signals',
+            type=str_to_bool,
+            default=False,
+            help='Do not call the save & delete signal receivers connected '
+                 'for the model while synchronising. Default:False')
 
     def handle(self, *args, **options):
         external_system = ExternalSystemHelper.find(
@@ -48,27 +75,42 @@ class Command(BaseCommand):
         if not os.path.exists(filename):
             raise CommandError("Filename '{}' not found".format(filename))
 
-        with open(filename) as f:
+        # The csv module handles the line endings itself, including those
+        # in quoted values
+        with open(filename, newline='', buffering=READ_BUFFER_SIZE) as f:
             # TODO - Review - This indirection is only due to issues in
             # getting the mocks in the tests to work
             SyncFileAction.sync(external_system,
                                 model,
                                 f,
-                                options['as_transaction'])
+                                options['as_transaction'],
+                                options['use_bulk'],
+                                options['chunk_size'],
+                                options['disable_signals'])
 
 
 class SyncFileAction:
     @staticmethod
-    def sync(external_system, model, file, use_transaction):
-        reader = csv.DictReader(file)
+    def sync(external_system, model, file, use_transaction, use_bulk=False,
+             chunk_size=None, disable_signals=False):
+        reader = csv.reader(file)
+        headers = next(reader, None)
         builder = CsvActionFactory(model, external_system)
-        actions = []
-        for d in reader:
-            actions.extend(builder.from_dict(d))
-
-        policy = BasicSyncPolicy(actions)
+        with contextlib.ExitStack() as stack:
+            actions = []
+            if headers is not None and chunk_size:
+                # Read the file and build the actions for the next chunks
+                # while the current chunk is written to the database. Closing
+                # the iterator stops the background thread if the sync fails
+                actions = stack.enter_context(contextlib.closing(
+                    iterate_in_background(
+                        builder.iter_from_rows(headers, reader), chunk_size)))
+            elif headers is not None:
+                actions = builder.from_rows(headers, reader)
 
-        if use_transaction:
-            policy = TransactionSyncPolicy(policy)
+            policy = build_policy(actions, use_transaction=use_transaction,
+                                  use_bulk=use_bulk, chunk_size=chunk_size)
 
-        policy.execute()
+            if disable_signals:
+                stack.enter_context(model_signals_disconnected(model))
+            policy.execute()
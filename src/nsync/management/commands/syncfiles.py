@@ -1,18 +1,19 @@
 from django.core.management.base import BaseCommand, CommandError
+import contextlib
 import os
 import csv
 import argparse
 import re
 from .utils import (
+    READ_BUFFER_SIZE,
     ExternalSystemHelper,
     ModelFinder,
     SupportedFileChecker,
-    CsvActionFactory)
-from nsync.policies import (
-    BasicSyncPolicy,
-    OrderedSyncPolicy,
-    TransactionSyncPolicy
-)
+    CsvActionFactory,
+    build_policy,
+    model_signals_disconnected,
+    positive_int,
+    str_to_bool)
 
 (DEFAULT_FILE_REGEX) = (r'(?P<external_system>[a-zA-Z0-9]+)_'
                         r'(?P<app_name>[a-zA-Z0-9]+)_'
@@ -24,7 +25,10 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         # Mandatory
-        parser.add_argument('files', type=argparse.FileType('r'), nargs='+')
+        parser.add_argument(
+            'files',
+            type=argparse.FileType('r', bufsize=READ_BUFFER_SIZE),
+            nargs='+')
         # Optional
         parser.add_argument(
             '--file_name_regex',
@@ -34,13 +38,13 @@ class Command(BaseCommand):
                  'and model name from each file')
         parser.add_argument(
             '--create_external_system',
-            type=bool,
+            type=str_to_bool,
             default=True,
             help='If true, the command will create a matching external '
                  'system object if one cannot be found')
         parser.add_argument(
             '--smart_ordering',
-            type=bool,
+            type=str_to_bool,
             default=True,
             help='When this option it true, the command will perform all '
                  'Create actions, then Update actions, and finally Delete '
@@ -49,9 +53,28 @@ class Command(BaseCommand):
                  'provided to the command is not important. Default: True')
         parser.add_argument(
             '--as_transaction',
-            type=bool,
+            type=str_to_bool,
             default=True,
             help='Wrap all of the actions in a DB transaction Default:True')
+        parser.add_argument(
+            '--use_bulk',
+            type=str_to_bool,
+            default=False,
+            help='Write the changes to the database in bulk where possible. '
+                 'Default:False')
+        parser.add_argument(
+            '--chunk_size',
+            type=positive_int,
+            default=None,
+            help='The number of actions to prepare and write together. '
+                 'Default: All of them')
+        parser.add_argument(
+            '--disable_signals',
+            type=str_to_bool,
+            default=False,
+            help='Do not call the save & delete signal receivers connected '
+                 'for the models of the files while synchronising. '
+                 'Default:False')
 
     def handle(self, *args, **options):
         TestableCommand(**options).execute()
@@ -64,22 +87,30 @@ class TestableCommand:
         self.create_external_system = options['create_external_system']
         self.ordered = options['smart_ordering']
         self.use_transaction = options['as_transaction']
+        self.use_bulk = options['use_bulk']
+        self.chunk_size = options['chunk_size']
+        self.disable_signals = options['disable_signals']
+        # The models the files are for
+        self.models = set()
 
     def execute(self):
         actions = self.collect_all_actions()
 
-        if self.ordered:
-            policy = OrderedSyncPolicy(actions)
-        else:
-            policy = BasicSyncPolicy(actions)
-
-        if self.use_transaction:
-            policy = TransactionSyncPolicy(policy)
-
-        policy.execute()
+        policy = build_policy(actions, ordered=self.ordered,
+                              use_transaction=self.use_transaction,
+                              use_bulk=self.use_bulk,
+                              chunk_size=self.chunk_size)
+        with contextlib.ExitStack() as stack:
+            if self.disable_signals:
+                # One scope for all of the models, rather than one each
+                stack.enter_context(model_signals_disconnected(*self.models))
+            policy.execute()
 
     def collect_all_actions(self):
         actions = []
+        # Several files are often for the same external system, so only
+        # look each of them up once
+        external_systems = {}
 
         for f in self.files:
             if not SupportedFileChecker.is_valid(f):
@@ -88,14 +119,20 @@ class TestableCommand:
             basename = os.path.basename(f.name)
             (system, app, model) = TargetExtractor(self.pattern).extract(
                 basename)
-            external_system = ExternalSystemHelper.find(
-                system, self.create_external_system)
+            external_system = external_systems.get(system)
+            if external_system is None:
+                external_system = external_systems[system] = \
+                    ExternalSystemHelper.find(system,
+                                              self.create_external_system)
             model = ModelFinder.find(app, model)
+            self.models.add(model)
 
-            reader = csv.DictReader(f)
+            reader = csv.reader(f)
+            headers = next(reader, None)
+            if headers is None:
+                continue
             builder = CsvActionFactory(model, external_system)
-            for d in reader:
-                actions.extend(builder.from_dict(d))
+            actions.extend(builder.from_rows(headers, reader))
         return actions
 
 
@@ -1,9 +1,25 @@
 from django.core.management.base import CommandError  # TODO replace error
 from django.apps.registry import apps
+from django.db.models import signals
+import argparse
+import contextlib
 import csv
+import itertools
+import queue
+import sys
+import threading
+import weakref
 
 from nsync.models import ExternalSystem
 from nsync.actions import ActionFactory, SyncActions
+from nsync.policies import (
+    BasicSyncPolicy,
+    OrderedSyncPolicy,
+    TransactionSyncPolicy
+)
+
+# Read the files in large blocks, as they are read from start to end
+READ_BUFFER_SIZE = 1 << 20
 
 
 class SupportedFileChecker:
@@ -42,6 +58,66 @@ class ExternalSystemHelper:
                     name))
 
 
+def str_to_bool(value):
+    """
+    Convert a command line option value to a boolean, as the argparse type
+    for boolean options (bool() would treat any non-empty value, including
+    'False', as True).
+
+    :param value: The value given for the option, e.g. 'true', 'no' or '0'
+    :return: True or False
+    """
+    if isinstance(value, bool):
+        return value
+    lowered = value.strip().lower()
+    if lowered in ('true', 't', 'yes', 'y', 'on', '1'):
+        return True
+    if lowered in ('false', 'f', 'no', 'n', 'off', '0'):
+        return False
+    raise argparse.ArgumentTypeError(
+        'Invalid boolean value "{}"'.format(value))
+
+
+def positive_int(value):
+    """
+    Convert a command line option value to a positive integer, as the argparse
+    type for counts such as the chunk size.
+
+    :param value: The value given for the option, e.g. '1000'
+    :return: The integer
+    """
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            'Invalid positive integer value "{}"'.format(value))
+    return number
+
+
+def build_policy(actions, ordered=False, use_transaction=True,
+                 use_bulk=False, chunk_size=None):
+    """
+    Build the synchronisation policy for the commands' options.
+
+    :param actions: The actions to perform
+    :param ordered: (Optional) Whether to perform all of the creates, then
+        the updates and then the deletes. Default: False
+    :param use_transaction: (Optional) Whether to perform all of the actions
+        in a single transaction. Default: True
+    :param use_bulk: (Optional) See BasicSyncPolicy. Default: False
+    :param chunk_size: (Optional) See BasicSyncPolicy. Default: None
+    :return: The policy to execute
+    """
+    policy_class = OrderedSyncPolicy if ordered else BasicSyncPolicy
+    policy = policy_class(actions, use_bulk=use_bulk, chunk_size=chunk_size)
+
+    if use_transaction:
+        policy = TransactionSyncPolicy(policy)
+    return policy
+
+
 class CsvActionFactory(ActionFactory):
     action_flags_label = 'action_flags'
     external_key_label = 'external_key'
@@ -52,16 +128,213 @@ class CsvActionFactory(ActionFactory):
         if not raw_values:
             return []
 
-        action_flags = raw_values.pop(self.action_flags_label)
-        match_on = raw_values.pop(self.match_on_label)
-        match_on = match_on.split(
+        # Read the values without popping them, so that the caller's dict
+        # is left as it was
+        action_flags = raw_values[self.action_flags_label]
+        match_on = raw_values[self.match_on_label].split(
             self.match_on_delimiter)
-        external_system_key = raw_values.pop(self.external_key_label, None)
+        external_system_key = raw_values.get(self.external_key_label)
+        special = (self.action_flags_label, self.match_on_label,
+                   self.external_key_label)
+        fields = {key: value for key, value in raw_values.items()
+                  if key not in special}
 
         sync_actions = CsvSyncActionsDecoder.decode(action_flags)
 
         return self.build(sync_actions, match_on,
-                          external_system_key, raw_values)
+                          external_system_key, fields)
+
+    def from_rows(self, headers, rows):
+        """
+        Build the actions for the rows of a CSV file.
+
+        This produces the same actions as calling from_dict() for each of the
+        rows read by a csv.DictReader, but it only works out which columns
+        hold the action flags, match on and external key values once, rather
+        than building and then picking apart a dict for every row.
+
+        :param headers: The list of column names (i.e. the first row)
+        :param rows: An iterable of the remaining rows (i.e. a csv.reader)
+        :return: The list of actions for all of the rows
+        """
+        return list(self.iter_from_rows(headers, rows))
+
+    def iter_from_rows(self, headers, rows):
+        """
+        A generator version of from_rows(), which only reads each row when
+        its actions are needed.
+        """
+        # The column names become the keys of every row's fields and the
+        # attribute names set on the objects, so intern them once
+        headers = [sys.intern(header) for header in headers]
+        # As with a dict of the row, the last of any duplicated columns wins
+        positions = {header: i for i, header in enumerate(headers)}
+        action_flags_index = positions.get(self.action_flags_label)
+        match_on_index = positions.get(self.match_on_label)
+        external_key_index = positions.get(self.external_key_label)
+        special = (self.action_flags_label, self.match_on_label,
+                   self.external_key_label)
+        field_columns = [(header, i) for header, i in positions.items()
+                         if header not in special]
+        width = len(headers)
+        # Resolve these once, rather than for every row
+        decode = CsvSyncActionsDecoder.decode
+        delimiter = self.match_on_delimiter
+        build = self.build
+        # The match_on values rarely change from row to row, so each of them
+        # is only split once. The lists are shared, so must not be changed.
+        split_match_ons = {}
+
+        for row in rows:
+            if not row:
+                # csv.DictReader skips blank lines too
+                continue
+            if len(row) < width:
+                row = row + [None] * (width - len(row))
+
+            if action_flags_index is None:
+                raise KeyError(self.action_flags_label)
+            if match_on_index is None:
+                raise KeyError(self.match_on_label)
+
+            sync_actions = decode(row[action_flags_index])
+            raw_match_on = row[match_on_index]
+            match_on = split_match_ons.get(raw_match_on)
+            if match_on is None:
+                match_on = split_match_ons[raw_match_on] = \
+                    raw_match_on.split(delimiter)
+            external_system_key = (row[external_key_index]
+                                   if external_key_index is not None
+                                   else None)
+            fields = {header: row[i] for header, i in field_columns}
+
+            yield from build(sync_actions, match_on, external_system_key,
+                             fields)
+
+
+def _model_receivers(signal, model):
+    """
+    Find the receivers connected to the signal for the model (i.e. with
+    sender=model), as (receiver, weak, dispatch_uid) tuples that can be
+    passed back to Signal.connect().
+    """
+    with signal.lock:
+        entries = list(signal.receivers)
+    found = []
+    for entry in entries:
+        # The lookup key of each receiver is (receiver id or dispatch_uid,
+        # sender id)
+        lookup_key, ref = entry[0], entry[1]
+        if lookup_key[1] != id(model):
+            continue
+        weak = isinstance(ref, weakref.ref)
+        receiver = ref() if weak else ref
+        if receiver is None:
+            continue  # Already garbage collected
+        if hasattr(receiver, '__self__') and hasattr(receiver, '__func__'):
+            receiver_id = (id(receiver.__self__), id(receiver.__func__))
+        else:
+            receiver_id = id(receiver)
+        dispatch_uid = lookup_key[0] if lookup_key[0] != receiver_id else None
+        found.append((receiver, weak, dispatch_uid))
+    return found
+
+
+@contextlib.contextmanager
+def model_signals_disconnected(*models, model_signals=(signals.pre_save,
+                                                      signals.post_save,
+                                                      signals.pre_delete,
+                                                      signals.post_delete)):
+    """
+    Temporarily disconnect the receivers connected to the signals for the
+    models (i.e. with sender=model).
+
+    Receivers connected for all senders are still called, and the receivers
+    are connected again (after the other receivers) when the block exits.
+    Using a single block for all of the models of a sync
+    saves disconnecting and reconnecting the receivers for each of them in
+    turn.
+
+    The receivers are disconnected for the whole process, so this is not
+    thread-safe: other threads saving or deleting the models while the block
+    runs do not call them either.
+
+    :param models: The model classes to silence the signals of
+    :param model_signals: (Optional) The signals to silence. Default: the
+        pre/post save & delete signals
+    :return: A context manager
+    """
+    disconnected = []
+    try:
+        for signal in model_signals:
+            for model in models:
+                for receiver, weak, dispatch_uid in _model_receivers(signal,
+                                                                     model):
+                    signal.disconnect(receiver, sender=model,
+                                      dispatch_uid=dispatch_uid)
+                    disconnected.append(
+                        (signal, model, receiver, weak, dispatch_uid))
+        yield
+    finally:
+        for signal, model, receiver, weak, dispatch_uid in disconnected:
+            signal.connect(receiver, sender=model, weak=weak,
+                           dispatch_uid=dispatch_uid)
+
+
+def iterate_in_background(iterable, chunk_size, max_chunks=4):
+    """
+    Iterate over the iterable in a background thread, so that producing the
+    items (e.g. reading and parsing a file) overlaps with consuming them.
+
+    The items are handed over in lists of up to chunk_size items, with at
+    most max_chunks lists waiting to be consumed. Any exception raised by the
+    iterable is raised again by this generator.
+
+    :param iterable: The iterable to iterate over; it must not use the
+        database, as the background thread has its own connection
+    :param chunk_size: The number of items to hand over at a time
+    :param max_chunks: (Optional) The number of lists that can be waiting
+        to be consumed. Default: 4
+    :return: A generator of the items, in order
+    """
+    chunks = queue.Queue(max_chunks)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up if the consumer has stopped, rather than blocking forever
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def produce():
+        try:
+            items = iter(iterable)
+            while not stop.is_set():
+                chunk = list(itertools.islice(items, chunk_size))
+                if not chunk:
+                    break
+                put(chunk)
+            put(done)
+        except Exception as e:
+            put(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield from chunk
+    finally:
+        stop.set()
+        producer.join()
 
 
 class CsvSyncActionsEncoder:
@@ -75,21 +348,29 @@ class CsvSyncActionsEncoder:
 
 
 class CsvSyncActionsDecoder:
-    @staticmethod
-    def decode(action_flags):
-        create = False
-        update = False
-        delete = False
-        force = False
+    CREATE = 1
+    UPDATE = 2
+    DELETE = 4
+    FORCE = 8
+    # The action(s) each of the flag characters stands for
+    FLAGS = {
+        'C': CREATE, 'c': CREATE,
+        'U': UPDATE, 'u': UPDATE,
+        'D': DELETE, 'd': DELETE,
+        '*': FORCE,
+    }
 
-        if action_flags:
-            try:
-                create = 'C' in action_flags or 'c' in action_flags
-                update = 'U' in action_flags or 'u' in action_flags
-                delete = 'D' in action_flags or 'd' in action_flags
-                force = '*' in action_flags
-            except TypeError:
-                # not iterable
-                pass
+    @classmethod
+    def decode(cls, action_flags):
+        if not action_flags or not isinstance(action_flags, str):
+            return SyncActions()
+
+        flags = cls.FLAGS
+        mask = 0
+        for flag in action_flags:
+            mask |= flags.get(flag, 0)
 
-        return SyncActions(create, update, delete, force)
+        return SyncActions(bool(mask & cls.CREATE),
+                           bool(mask & cls.UPDATE),
+                           bool(mask & cls.DELETE),
+                           bool(mask & cls.FORCE))
@@ -1,20 +1,56 @@
 from django.db import transaction
+import itertools
+
+from .actions import ActionBatch
+
+
+def execute_in_batches(actions, use_bulk=False, chunk_size=None):
+    """
+    Execute the actions in order, as ActionBatches of up to chunk_size
+    actions each.
+
+    :param actions: An iterable of the actions to perform
+    :param use_bulk: (Optional) Whether the actions should write their
+        changes in bulk where possible. Default: False
+    :param chunk_size: (Optional) The maximum number of actions in each
+        batch. Default: None, i.e. all of the actions in a single batch
+    :return: Nothing
+    """
+    if chunk_size is not None and chunk_size < 1:
+        raise ValueError('chunk_size({}) must be a positive number'.format(
+            chunk_size))
+
+    actions = iter(actions)
+    while True:
+        chunk = list(itertools.islice(actions, chunk_size))
+        if not chunk:
+            return
+
+        batch = ActionBatch(chunk, use_bulk).prepare()
+        for action in chunk:
+            action.execute()
+        batch.flush()
 
 
 class BasicSyncPolicy:
     """A synchronisation policy that simply executes each action in order."""
-    def __init__(self, actions):
+    def __init__(self, actions, use_bulk=False, chunk_size=None):
         """
         Create a basic synchronisation policy.
 
         :param actions: The list of actions to perform
+        :param use_bulk: (Optional) Whether the actions should write their
+            changes in bulk where possible. Default: False
+        :param chunk_size: (Optional) The maximum number of actions to
+            prepare and flush together. Default: None, i.e. all of them
         :return: Nothing
         """
         self.actions = actions
+        self.use_bulk = use_bulk
+        self.chunk_size = chunk_size
 
     def execute(self):
-        for action in self.actions:
-            action.execute()
+        execute_in_batches(self.actions, self.use_bulk, self.chunk_size)
 
 
 class TransactionSyncPolicy:
@@ -54,12 +90,24 @@ class OrderedSyncPolicy:
     This also helps with referential updates, where an update action might be
     earlier in the list than the action to create the referred to object.
     """
-    def __init__(self, actions):
+    def __init__(self, actions, use_bulk=False, chunk_size=None):
         self.actions = actions
+        self.use_bulk = use_bulk
+        self.chunk_size = chunk_size
+
+    ORDER = ('create', 'update', 'delete')
 
     def execute(self):
-        for filter_by in ['create', 'update', 'delete']:
-            filtered_actions = filter(lambda a: a.type == filter_by,
-                                      self.actions)
-            for action in filtered_actions:
-                action.execute()
+        # Sort the actions in a single pass, so that the actions can also be
+        # provided by an iterator
+        actions_by_type = {action_type: [] for action_type in self.ORDER}
+        for action in self.actions:
+            same_type = actions_by_type.get(action.type)
+            if same_type is not None:
+                same_type.append(action)
+
+        for action_type in self.ORDER:
+            # Each kind of action is flushed before the next starts, so that
+            # its changes are visible to it
+            execute_in_batches(actions_by_type[action_type], self.use_bulk,
+                               self.chunk_size)
@@ -32,6 +32,7 @@ class TestHouse(models.Model):
     owner = models.ForeignKey(TestPerson, blank=True, null=True, related_name='houses',
         on_delete=models.CASCADE)
     built = models.DateField(blank=True, null=True)
+    last_updated = models.DateTimeField(auto_now=True, null=True)
 
     def __str__(self):
         return '{} - {}{}{}{}'.format(
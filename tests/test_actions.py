@@ -1,10 +1,15 @@
-from unittest.mock import MagicMock, patch, ANY
+import datetime
+from unittest.mock import MagicMock, patch, ANY, call
 
 from django.contrib.contenttypes.fields import ContentType
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
 from django.db.models.query_utils import Q
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from nsync.actions import (
+    _field_plan,
+    _get_field,
     CreateModelAction,
     UpdateModelAction,
     DeleteModelAction,
@@ -13,6 +18,7 @@ from nsync.actions import (
     DeleteExternalReferenceAction,
     DeleteIfOnlyReferenceModelAction,
     SyncActions,
+    ActionBatch,
     ActionFactory,
     ObjectSelector,
     ModelAction)
@@ -21,6 +27,15 @@ from nsync.models import ExternalSystem, ExternalKeyMapping
 from tests.models import TestPerson, TestHouse, TestBuilder
 
 
+def make_mapping(external_system, external_key, obj):
+    return ExternalKeyMapping.objects.create(
+        external_system=external_system,
+        external_key=external_key,
+        content_type=ContentType.objects.get_for_model(type(obj)),
+        content_object=obj,
+        object_id=obj.id)
+
+
 class TestSyncActions(TestCase):
     def test_sync_actions_raises_error_if_action_includes_create_and_delete(
             self):
@@ -105,6 +120,24 @@ class TestObjectSelector(TestCase, QTestMixin):
         self.assertQEqual((Q(field1='value1') & Q(field2='value2')) |
                               (~Q(field3='value3') & Q(field4='value4')), result)
 
+    def test_get_by_ANDs_more_than_two_fields_by_default(self):
+        sut = ObjectSelector(['field1', 'field2', 'field3'], self.fields)
+        result = sut.get_by()
+        self.assertQEqual(
+            Q(field1='value1') & Q(field2='value2') & Q(field3='value3'),
+            result)
+
+    def test_it_compiles_the_match_on_tokens_once(self):
+        sut = ObjectSelector(['field1', 'field2', '|'], self.fields)
+        with patch.object(ObjectSelector, 'compile') as compile:
+            sut.get_by()
+            compile.assert_not_called()
+
+    def test_get_by_uses_the_current_field_values(self):
+        sut = ObjectSelector(['field1', '~'], self.fields)
+        self.fields['field1'] = 'changed'
+        self.assertQEqual(~Q(field1='changed'), sut.get_by())
+
     def test_it_raises_an_error_if_insufficient_operands_for_AND(self):
         with self.assertRaises(ValueError):
             sut = ObjectSelector(['field1', '&'], self.fields)
@@ -368,6 +401,19 @@ class TestModelAction(TestCase):
         self.assertEqual(jill, house.owner)
         self.assertNotEqual(jack, house.owner)
 
+    def test_related_fields_update_does_not_load_the_assigned_object(self):
+        jill = TestPerson.objects.create(first_name="Jill", last_name="Jones")
+        TestHouse.objects.create(address='Bottom of the hill', owner=jill)
+        house = TestHouse.objects.get()
+
+        fields = {
+            'address': 'Bottom of the hill',
+            'owner=>first_name': 'Jack'}
+        sut = ModelAction(TestHouse, ['address'], fields)
+        with self.assertNumQueries(0):
+            sut.update_from_fields(house)
+        self.assertEqual(jill.pk, house.owner_id)
+
     def test_related_fields_update_does_update_if_forced(self):
         jill = TestPerson.objects.create(first_name="Jill", last_name="Jones")
         jack = TestPerson.objects.create(first_name="Jack", last_name="Jones")
@@ -503,12 +549,25 @@ class TestActionFactory(TestCase):
         self.model = MagicMock()
         self.sut = ActionFactory(self.model)
 
+    @patch('nsync.actions.UpdateModelAction')
+    def test_it_only_works_out_the_actions_for_each_combination_once(
+            self, UpdateModelAction):
+        with patch.object(self.sut, 'compile_builders',
+                          wraps=self.sut.compile_builders) as compile_builders:
+            for value in ['1', '2']:
+                self.sut.build(SyncActions(update=True), ['field'], None,
+                               {'field': value})
+            compile_builders.assert_called_once_with(False, True, False,
+                                                     False, False)
+        UpdateModelAction.assert_called_with(self.model, ['field'],
+                                             {'field': '2'}, False)
+
     @patch('nsync.actions.ModelAction')
-    def test_it_creates_a_base_model_action_if_no_action_flags_are_included(
+    def test_it_creates_no_actions_if_no_action_flags_are_included(
             self, ModelAction):
         result = self.sut.build(SyncActions(), ['field'], None, {'field': ''})
-        ModelAction.assert_called_with(self.model, ['field'], {'field': ''})
-        self.assertIn(ModelAction.return_value, result)
+        ModelAction.assert_not_called()
+        self.assertEqual([], result)
 
     @patch('nsync.actions.CreateModelAction')
     def test_it_calls_create_action_with_correct_parameters(self,
@@ -566,6 +625,11 @@ class TestActionFactory(TestCase):
         self.assertFalse(ActionFactory(ANY, ANY).is_externally_mappable(1))
         self.assertFalse(ActionFactory(ANY, ANY).is_externally_mappable(ANY))
 
+    def test_it_considers_blank_strings_as_not_externally_mappable(self):
+        sut = ActionFactory(ANY, ANY)
+        self.assertIs(False, sut.is_externally_mappable(''))
+        self.assertIs(False, sut.is_externally_mappable(' \t '))
+
     def test_it_considers_non_blank_strings_as_externally_mappable(self):
         self.assertTrue(
             ActionFactory(ANY, ANY).is_externally_mappable('a mappable key'))
@@ -827,6 +891,25 @@ class TestUpdateModelAction(TestCase):
         john.refresh_from_db()
         self.assertEquals('Jackson', john.last_name)
 
+    def test_it_saves_in_a_savepoint_inside_a_transaction(self):
+        TestPerson.objects.create(first_name='John')
+        sut = UpdateModelAction(TestPerson, ['first_name'],
+                                {'first_name': 'John', 'last_name': 'Smith'})
+        with patch('nsync.actions.transaction.atomic') as atomic:
+            sut.execute()
+            atomic.assert_any_call(using='default')
+
+    def test_it_does_not_use_a_savepoint_outside_a_transaction(self):
+        john = TestPerson.objects.create(first_name='John')
+        sut = UpdateModelAction(TestPerson, ['first_name'],
+                                {'first_name': 'John', 'last_name': 'Smith'})
+        with patch('nsync.actions.transaction.get_connection') as connection, \
+                patch('nsync.actions.transaction.atomic') as atomic:
+            connection.return_value.in_atomic_block = False
+            sut.execute()
+            atomic.assert_not_called()
+        john.refresh_from_db()
+        self.assertEqual('Smith', john.last_name)
 
 class TestUpdateModelWithReferenceAction(TestCase):
     """
@@ -950,6 +1033,40 @@ class TestUpdateModelWithReferenceAction(TestCase):
                 self.update_john.execute()
                 delete.assert_not_called()
 
+    def test_it_finds_the_linked_and_matched_objects_in_one_query(self):
+        linked_person = TestPerson.objects.create(first_name='Not John')
+        matched_person = TestPerson.objects.create(first_name='John')
+        make_mapping(self.external_system, 'PersonJohn', linked_person)
+        mapping = self.update_john.get_mapping()
+
+        with self.assertNumQueries(1):
+            linked, matched = self.update_john.get_linked_and_matched_objects(
+                mapping)
+        self.assertEqual(linked_person, linked)
+        self.assertEqual(matched_person, matched)
+
+    def test_it_finds_the_matched_object_if_the_linked_one_is_gone(self):
+        person = TestPerson.objects.create(first_name='Not John')
+        make_mapping(self.external_system, 'PersonJohn', person)
+        person.delete()
+        john = TestPerson.objects.create(first_name='John')
+
+        self.update_john.execute()
+        john.refresh_from_db()
+        self.assertEqual('Smith', john.last_name)
+        self.assertEqual(john, ExternalKeyMapping.objects.get().content_object)
+
+    def test_it_does_nothing_if_multiple_objects_are_matched(self):
+        linked_person = TestPerson.objects.create(first_name='Not John')
+        TestPerson.objects.create(first_name='John')
+        TestPerson.objects.create(first_name='John')
+        make_mapping(self.external_system, 'PersonJohn', linked_person)
+
+        self.assertIsNone(self.update_john.execute())
+        self.assertEqual(3, TestPerson.objects.count())
+        linked_person.refresh_from_db()
+        self.assertEqual('Not John', linked_person.first_name)
+
 
 class TestDeleteModelAction(TestCase):
     def test_no_objects_are_deleted_if_none_are_matched(self):
@@ -1045,6 +1162,133 @@ class TestDeleteIfOnlyReferenceModelAction(TestCase):
         self.assertFalse(delete_action.execute.called)
         delete_action.execute.assert_not_called()  # Works in py3.5
 
+    def test_it_does_not_call_the_delete_action_if_other_systems_have_other_keys(
+            self):
+        john = TestPerson.objects.create(first_name='John')
+        for system, key in [(self.external_system, 'Person123'),
+                            (ExternalSystem.objects.create(name='OtherSystem'),
+                             'AABB')]:
+            ExternalKeyMapping.objects.create(
+                external_system=system,
+                external_key=key,
+                content_type=ContentType.objects.get_for_model(TestPerson),
+                content_object=john,
+                object_id=john.id)
+        delete_action = MagicMock()
+        delete_action.model = TestPerson
+        delete_action.get_object.return_value = john
+        DeleteIfOnlyReferenceModelAction(self.external_system, 'Person123',
+                                         delete_action).execute()
+        delete_action.execute.assert_not_called()
+
+    def test_it_checks_the_key_mappings_with_a_single_query(self):
+        john = TestPerson.objects.create(first_name='John')
+        ExternalKeyMapping.objects.create(
+            external_system=self.external_system,
+            external_key='Person123',
+            content_type=ContentType.objects.get_for_model(TestPerson),
+            content_object=john,
+            object_id=john.id)
+        delete_action = MagicMock()
+        delete_action.model = TestPerson
+        delete_action.get_object.return_value = john
+        with self.assertNumQueries(1):
+            DeleteIfOnlyReferenceModelAction(self.external_system, 'Person123',
+                                             delete_action).execute()
+        delete_action.execute.assert_called_with()
+
+    def test_it_does_not_query_if_the_batch_knows_there_is_no_mapping(self):
+        TestPerson.objects.create(first_name='John')
+        delete_action = DeleteModelAction(TestPerson, ['first_name'],
+                                          {'first_name': 'John'})
+        sut = DeleteIfOnlyReferenceModelAction(self.external_system,
+                                               'Person123', delete_action)
+        ActionBatch([sut]).prepare()
+        with self.assertNumQueries(0):
+            sut.execute()
+        self.assertTrue(TestPerson.objects.filter(first_name='John').exists())
+
+    def test_it_deletes_in_a_batch_if_it_is_the_only_key_mapping(self):
+        john = TestPerson.objects.create(first_name='John')
+        ExternalKeyMapping.objects.create(
+            external_system=self.external_system,
+            external_key='Person123',
+            content_type=ContentType.objects.get_for_model(TestPerson),
+            content_object=john,
+            object_id=john.id)
+        delete_action = DeleteModelAction(TestPerson, ['first_name'],
+                                          {'first_name': 'John'})
+        sut = DeleteIfOnlyReferenceModelAction(self.external_system,
+                                               'Person123', delete_action)
+        batch = ActionBatch([sut], use_bulk=True).prepare()
+        sut.execute()
+        batch.flush()
+        self.assertFalse(TestPerson.objects.filter(first_name='John').exists())
+
+    def delete_rows(self, rows):
+        actions = []
+        for system, key, name in rows:
+            actions.append(DeleteIfOnlyReferenceModelAction(
+                system, key,
+                DeleteModelAction(TestPerson, ['first_name'],
+                                  {'first_name': name})))
+            actions.append(DeleteExternalReferenceAction(system, key))
+        return actions
+
+    def test_it_checks_the_references_together_in_a_batch_of_deletes(self):
+        other_system = ExternalSystem.objects.create(name='OtherSystem')
+        for name in ['John', 'Jill', 'Jack']:
+            make_mapping(self.external_system, name,
+                         TestPerson.objects.create(first_name=name))
+        make_mapping(other_system, 'Jack',
+                     TestPerson.objects.get(first_name='Jack'))
+        actions = self.delete_rows([(self.external_system, name, name)
+                                    for name in ['John', 'Jill', 'Jack']])
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        for action in actions:
+            action.execute()
+        self.assertEqual(3, TestPerson.objects.count())
+
+        with CaptureQueriesContext(connection) as queries:
+            batch.flush()
+        # One for the mappings and one for the people
+        self.assertEqual(2, len([query for query in queries
+                                 if query['sql'].startswith('DELETE')]))
+        self.assertEqual(['Jack'], list(
+            TestPerson.objects.values_list('first_name', flat=True)))
+        self.assertEqual([(other_system.pk, 'Jack')], list(
+            ExternalKeyMapping.objects.values_list('external_system_id',
+                                                   'external_key')))
+
+    def test_it_takes_the_other_mapping_deletes_in_the_batch_into_account(
+            self):
+        other_system = ExternalSystem.objects.create(name='OtherSystem')
+        john = TestPerson.objects.create(first_name='John')
+        make_mapping(self.external_system, 'John', john)
+        make_mapping(other_system, 'OtherJohn', john)
+        actions = self.delete_rows([(self.external_system, 'John', 'John'),
+                                    (other_system, 'OtherJohn', 'John')])
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        for action in actions:
+            action.execute()
+        batch.flush()
+        self.assertEqual(0, TestPerson.objects.count())
+        self.assertEqual(0, ExternalKeyMapping.objects.count())
+
+    def test_it_does_not_delete_objects_mapped_by_a_mapping_that_is_kept(
+            self):
+        other_system = ExternalSystem.objects.create(name='OtherSystem')
+        john = TestPerson.objects.create(first_name='John')
+        make_mapping(self.external_system, 'John', john)
+        make_mapping(other_system, 'OtherJohn', john)
+        actions = self.delete_rows([(self.external_system, 'John', 'John')])
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        for action in actions:
+            action.execute()
+        batch.flush()
+        self.assertEqual(1, TestPerson.objects.count())
+        self.assertEqual(1, ExternalKeyMapping.objects.count())
+
 
 class TestDeleteExternalReferenceAction(TestCase):
     def test_it_deletes_the_matching_external_reference(self):
@@ -1100,3 +1344,703 @@ class TestActionTypes(TestCase):
                           DeleteExternalReferenceAction(ANY, ANY).type)
 
         
+
+
+class TestActionBatch(TestCase):
+    def setUp(self):
+        self.external_system = ExternalSystem.objects.create(name='System')
+
+    @patch('nsync.actions.transaction.atomic')
+    def test_it_does_not_flush_if_there_is_nothing_to_write(self, atomic):
+        batch = ActionBatch([]).prepare()
+        batch.flush()
+        atomic.assert_not_called()
+
+    def test_it_forgets_the_found_objects_when_another_is_created(self):
+        john = TestPerson.objects.create(first_name='John', last_name='Smith')
+        actions = [
+            UpdateModelAction(TestPerson, ['last_name'],
+                              {'last_name': 'Smith', 'age': '30'}),
+            CreateModelAction(TestPerson, ['first_name'],
+                              {'first_name': 'Jack', 'last_name': 'Smith'}),
+            UpdateModelAction(TestPerson, ['last_name'],
+                              {'last_name': 'Smith', 'age': '40'},
+                              force_update=True)]
+        ActionBatch(actions).prepare()
+        for action in actions:
+            action.execute()
+        john.refresh_from_db()
+        # The second update finds both people, so it does not update either
+        self.assertEqual(30, john.age)
+        self.assertEqual(1, TestPerson.objects.filter(age=None).count())
+
+    def test_it_attaches_the_actions_to_the_batch(self):
+        delete_action = DeleteModelAction(TestPerson, ['first_name'],
+                                          {'first_name': 'John'})
+        actions = [
+            CreateModelAction(TestPerson, ['first_name'],
+                              {'first_name': 'John'}),
+            DeleteIfOnlyReferenceModelAction(self.external_system, 'Key',
+                                             delete_action),
+            DeleteExternalReferenceAction(self.external_system, 'Key')]
+        batch = ActionBatch(actions).prepare()
+        for action in actions:
+            self.assertIs(batch, action.batch)
+        self.assertIs(batch, delete_action.batch)
+
+    def test_it_ignores_actions_it_does_not_know(self):
+        action = MagicMock()
+        with self.assertNumQueries(0):
+            ActionBatch([action]).prepare()
+
+    def test_it_fetches_the_mappings_and_their_objects_in_a_query_each(self):
+        for name in ['John', 'Jill', 'Jack']:
+            make_mapping(self.external_system, name,
+                         TestPerson.objects.create(first_name=name))
+
+        actions = [UpdateModelWithReferenceAction(
+            self.external_system, TestPerson, name, ['first_name'],
+            {'first_name': name}) for name in ['John', 'Jill', 'Jack', 'Jo']]
+        with self.assertNumQueries(2):
+            batch = ActionBatch(actions).prepare()
+
+        self.assertEqual(4, len(batch.mappings))
+        self.assertIsNone(batch.mappings[(self.external_system.pk, 'Jo')])
+        self.assertEqual(
+            'John',
+            batch.mappings[(self.external_system.pk, 'John')].external_key)
+
+    def test_prepared_actions_do_not_query_for_their_mapping(self):
+        john = TestPerson.objects.create(first_name='John')
+        mapping = make_mapping(self.external_system, 'PersonJohn', john)
+        sut = CreateModelWithReferenceAction(
+            self.external_system, TestPerson, 'PersonJohn', ['first_name'],
+            {'first_name': 'John'})
+        ActionBatch([sut]).prepare()
+        with patch.object(ExternalKeyMapping.objects, 'get') as get:
+            self.assertEqual(mapping, sut.get_mapping())
+            get.assert_not_called()
+
+    def test_prepared_actions_do_not_query_for_the_mapped_object(self):
+        john = TestPerson.objects.create(first_name='John')
+        make_mapping(self.external_system, 'PersonJohn', john)
+        sut = CreateModelWithReferenceAction(
+            self.external_system, TestPerson, 'PersonJohn', ['first_name'],
+            {'first_name': 'John'})
+        ActionBatch([sut]).prepare()
+        with self.assertNumQueries(0):
+            self.assertEqual(john, sut.execute())
+
+    def test_it_reloads_mapped_objects_updated_through_other_instances(self):
+        john = TestPerson.objects.create(first_name='John')
+        make_mapping(self.external_system, 'PersonJohn', john)
+        update = UpdateModelAction(TestPerson, ['first_name'],
+                                   {'first_name': 'John', 'age': '40'})
+        update_with_ref = UpdateModelWithReferenceAction(
+            self.external_system, TestPerson, 'PersonJohn', ['first_name'],
+            {'first_name': 'John', 'last_name': 'Smith'})
+        ActionBatch([update, update_with_ref]).prepare()
+        update.execute()
+        update_with_ref.execute()
+        john.refresh_from_db()
+        self.assertEqual(40, john.age)
+        self.assertEqual('Smith', john.last_name)
+
+    def test_it_reloads_mapped_objects_after_deletes(self):
+        john = TestPerson.objects.create(first_name='John')
+        make_mapping(self.external_system, 'PersonJohn', john)
+        delete = DeleteModelAction(TestPerson, ['first_name'],
+                                   {'first_name': 'John'})
+        update_with_ref = UpdateModelWithReferenceAction(
+            self.external_system, TestPerson, 'PersonJohn', ['first_name'],
+            {'first_name': 'John', 'last_name': 'Smith'})
+        ActionBatch([delete, update_with_ref]).prepare()
+        delete.execute()
+        self.assertIsNone(update_with_ref.execute())
+        self.assertEqual(0, TestPerson.objects.count())
+
+    def test_it_shares_mappings_saved_by_earlier_actions(self):
+        create = CreateModelWithReferenceAction(
+            self.external_system, TestPerson, 'PersonJohn', ['first_name'],
+            {'first_name': 'John'})
+        update = UpdateModelWithReferenceAction(
+            self.external_system, TestPerson, 'PersonJohn', ['first_name'],
+            {'first_name': 'John', 'last_name': 'Smith'})
+        ActionBatch([create, update]).prepare()
+        create.execute()
+        update.execute()
+        self.assertEqual(1, ExternalKeyMapping.objects.count())
+        self.assertEqual('Smith', TestPerson.objects.get().last_name)
+
+    def test_it_forgets_mappings_that_are_deleted(self):
+        make_mapping(self.external_system, 'PersonJohn',
+                     TestPerson.objects.create(first_name='John'))
+        sut = DeleteExternalReferenceAction(self.external_system,
+                                            'PersonJohn')
+        batch = ActionBatch([sut]).prepare()
+        sut.execute()
+        self.assertIsNone(
+            batch.mappings[(self.external_system.pk, 'PersonJohn')])
+
+
+class TestFieldCache(TestCase):
+    def test_it_returns_the_field_for_the_model(self):
+        self.assertEqual(TestPerson._meta.get_field('first_name'),
+                         _get_field(TestPerson, 'first_name'))
+
+    def test_it_returns_none_if_the_field_does_not_exist(self):
+        self.assertIsNone(_get_field(TestPerson, 'not_a_field'))
+
+    def test_it_only_looks_up_each_field_once(self):
+        _get_field(TestHouse, 'address')
+        with patch.object(TestHouse._meta, 'get_field') as get_field:
+            _get_field(TestHouse, 'address')
+            get_field.assert_not_called()
+
+    def test_the_caches_are_bounded(self):
+        self.assertIsNotNone(_get_field.cache_info().maxsize)
+        self.assertIsNotNone(_field_plan.cache_info().maxsize)
+
+
+class TestFieldPlan(TestCase):
+    def test_it_parses_the_attributes(self):
+        self.assertEqual(
+            [('address', None, 'address', False, 'address', 'address'),
+             ('floors', None, 'floors', True, 'floors', 'floors'),
+             ('owner', None, 'owner_id', True, 'owner', None),
+             ('owner=>first_name', ('owner', 'first_name'),
+              'owner=>first_name', False, None, None),
+             ('not_a_field', None, 'not_a_field', False, None, None)],
+            _field_plan(TestHouse,
+                        ('address', 'floors', 'owner', 'owner=>first_name',
+                         'not_a_field')))
+
+    def test_it_does_not_mark_many_to_many_fields_as_changed(self):
+        self.assertEqual(
+            [('buildings', None, 'buildings', False, None, None)],
+            _field_plan(TestBuilder, ('buildings',)))
+
+    def test_it_does_not_mark_the_primary_key_as_changed(self):
+        self.assertEqual(
+            [('id', None, 'id', False, None, 'id')],
+            _field_plan(TestPerson, ('id',)))
+
+    def test_it_sets_fields_with_a_data_descriptor_with_setattr(self):
+        class Setter:
+            def __get__(self, instance, owner):
+                return self
+            def __set__(self, instance, value):
+                pass
+
+        with patch.object(TestHouse, 'country', Setter(), create=True):
+            plan = _field_plan.__wrapped__(TestHouse, ('country',))
+        self.assertIsNone(plan[0][5])
+
+    def test_actions_with_the_same_attributes_share_the_plan(self):
+        actions = [ModelAction(TestHouse, ['address'],
+                               {'address': address, 'owner=>first_name': 'Jo'})
+                   for address in ['Top of the hill', 'Bottom of the hill']]
+        self.assertIs(actions[0].field_plan(TestHouse),
+                      actions[1].field_plan(TestHouse))
+
+
+class TestActionBatchObjects(TestCase):
+    def test_actions_matching_the_same_object_only_query_for_it_once(self):
+        john = TestPerson.objects.create(first_name='John')
+        actions = [UpdateModelAction(TestPerson, ['first_name'],
+                                     {'first_name': 'John', 'age': age})
+                   for age in ['30', '31']]
+        ActionBatch(actions).prepare()
+        self.assertEqual(john, actions[0].get_object())
+        with self.assertNumQueries(0):
+            self.assertEqual(john, actions[1].get_object())
+
+    def test_it_does_not_remember_missing_objects(self):
+        sut = CreateModelAction(TestPerson, ['first_name'],
+                                {'first_name': 'John'})
+        ActionBatch([sut]).prepare()
+        with self.assertRaises(ObjectDoesNotExist):
+            sut.get_object()
+        john = TestPerson.objects.create(first_name='John')
+        self.assertEqual(john, sut.get_object())
+
+    def test_it_forgets_objects_when_objects_are_deleted(self):
+        TestPerson.objects.create(first_name='John')
+        find = CreateModelAction(TestPerson, ['first_name'],
+                                 {'first_name': 'John'})
+        delete = DeleteModelAction(TestPerson, ['first_name'],
+                                   {'first_name': 'John'})
+        ActionBatch([find, delete]).prepare()
+        find.execute()
+        delete.execute()
+        with self.assertRaises(ObjectDoesNotExist):
+            find.get_object()
+
+    def test_it_forgets_objects_whose_match_fields_are_updated(self):
+        TestPerson.objects.create(first_name='John', last_name='Smith')
+        find = CreateModelAction(TestPerson, ['first_name'],
+                                 {'first_name': 'John'})
+        rename = UpdateModelAction(TestPerson, ['last_name'],
+                                   {'last_name': 'Smith', 'first_name': 'Jack'},
+                                   force_update=True)
+        ActionBatch([find, rename]).prepare()
+        find.execute()
+        rename.execute()
+        with self.assertRaises(ObjectDoesNotExist):
+            find.get_object()
+
+    def test_it_forgets_other_instances_of_updated_objects(self):
+        john = TestPerson.objects.create(first_name='John', last_name='Smith')
+        find = CreateModelAction(TestPerson, ['first_name'],
+                                 {'first_name': 'John'})
+        update = UpdateModelAction(TestPerson, ['last_name'],
+                                   {'last_name': 'Smith', 'age': '40'},
+                                   force_update=True)
+        ActionBatch([find, update]).prepare()
+        find.execute()
+        update.execute()
+        self.assertEqual(40, find.get_object().age)
+
+
+class TestActionBatchRelatedObjects(TestCase):
+    def make_actions(self, fields_list):
+        return [UpdateModelAction(TestHouse, ['address'], fields,
+                                  force_update=True)
+                for fields in fields_list]
+
+    def test_it_fetches_the_referred_to_objects_in_a_single_query(self):
+        for name in ['John', 'Jill']:
+            TestPerson.objects.create(first_name=name)
+            TestHouse.objects.create(address=name)
+        actions = self.make_actions([
+            {'address': name, 'owner=>first_name': name}
+            for name in ['John', 'Jill', 'Jack']])
+
+        with self.assertNumQueries(1):
+            batch = ActionBatch(actions).prepare()
+        self.assertEqual(
+            {'John', 'Jill'},
+            set(batch.related_objects[(TestPerson, 'first_name')]))
+
+    def test_prepared_actions_do_not_query_for_referred_to_objects(self):
+        john = TestPerson.objects.create(first_name='John')
+        house = TestHouse.objects.create(address='Bottom of the hill')
+        sut, = self.make_actions([{'address': 'Bottom of the hill',
+                                   'owner=>first_name': 'John'}])
+        ActionBatch([sut]).prepare()
+        with patch.object(TestPerson.objects, 'get') as get:
+            sut.update_from_fields(house, True)
+            get.assert_not_called()
+        self.assertEqual(john, house.owner)
+
+    def test_it_prefetches_many_to_many_targets(self):
+        house = TestHouse.objects.create(address='Bottom of the hill')
+        sut = UpdateModelAction(TestBuilder, ['first_name'], {
+            'first_name': 'Bob', 'buildings=>+address': 'Bottom of the hill'})
+        batch = ActionBatch([sut]).prepare()
+        self.assertEqual(
+            {'Bottom of the hill': house},
+            batch.related_objects[(TestHouse, 'address')])
+
+    def test_it_leaves_out_values_shared_by_several_objects(self):
+        TestPerson.objects.create(first_name='John')
+        TestPerson.objects.create(first_name='John')
+        house = TestHouse.objects.create(address='Bottom of the hill')
+        sut, = self.make_actions([{'address': 'Bottom of the hill',
+                                   'owner=>first_name': 'John'}])
+        ActionBatch([sut]).prepare()
+        sut.execute()
+        house.refresh_from_db()
+        self.assertIsNone(house.owner)
+
+    def test_it_does_not_prefetch_multi_field_lookups(self):
+        sut, = self.make_actions([{'address': 'Bottom of the hill',
+                                   'owner=>first_name': 'John',
+                                   'owner=>last_name': 'Smith'}])
+        with self.assertNumQueries(0):
+            batch = ActionBatch([sut]).prepare()
+        self.assertEqual({}, batch.related_objects)
+
+    def test_it_finds_objects_created_after_preparing(self):
+        house = TestHouse.objects.create(address='Bottom of the hill')
+        sut, = self.make_actions([{'address': 'Bottom of the hill',
+                                   'owner=>first_name': 'John'}])
+        ActionBatch([sut]).prepare()
+        john = TestPerson.objects.create(first_name='John')
+        sut.execute()
+        house.refresh_from_db()
+        self.assertEqual(john, house.owner)
+
+    def test_it_forgets_objects_whose_lookup_field_is_updated(self):
+        TestPerson.objects.create(first_name='John')
+        house = TestHouse.objects.create(address='Bottom of the hill')
+        rename = UpdateModelAction(TestPerson, ['last_name'],
+                                   {'last_name': '', 'first_name': 'Jack'},
+                                   force_update=True)
+        sut, = self.make_actions([{'address': 'Bottom of the hill',
+                                   'owner=>first_name': 'John'}])
+        ActionBatch([rename, sut]).prepare()
+        rename.execute()
+        sut.execute()
+        house.refresh_from_db()
+        self.assertIsNone(house.owner)
+
+    def test_it_forgets_objects_when_objects_are_deleted(self):
+        TestPerson.objects.create(first_name='John')
+        house = TestHouse.objects.create(address='Bottom of the hill')
+        delete = DeleteModelAction(TestPerson, ['first_name'],
+                                   {'first_name': 'John'})
+        sut, = self.make_actions([{'address': 'Bottom of the hill',
+                                   'owner=>first_name': 'John'}])
+        batch = ActionBatch([delete, sut]).prepare()
+        delete.execute()
+        self.assertEqual({}, batch.related_objects)
+        self.assertEqual({}, batch.objects)
+
+
+class TestActionBatchBulkMode(TestCase):
+    def setUp(self):
+        self.external_system = ExternalSystem.objects.create(name='System')
+
+    def create_with_ref(self, name):
+        return CreateModelWithReferenceAction(
+            self.external_system, TestPerson, name, ['first_name'],
+            {'first_name': name})
+
+    def test_it_defers_new_mappings_until_flushed(self):
+        actions = [self.create_with_ref(name) for name in ['John', 'Jill']]
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        for action in actions:
+            action.execute()
+        self.assertEqual(0, ExternalKeyMapping.objects.count())
+
+        # One insert for the people and one for the mappings
+        with self.assertNumQueries(2):
+            batch.flush()
+        self.assertEqual(2, ExternalKeyMapping.objects.count())
+        for mapping in ExternalKeyMapping.objects.all():
+            self.assertEqual(mapping.external_key,
+                             mapping.content_object.first_name)
+
+    def test_it_does_not_save_mappings_that_are_unchanged(self):
+        john = TestPerson.objects.create(first_name='John')
+        ExternalKeyMapping.objects.create(
+            external_system=self.external_system,
+            external_key='John',
+            content_type=ContentType.objects.get_for_model(TestPerson),
+            content_object=john,
+            object_id=john.id)
+        sut = self.create_with_ref('John')
+        batch = ActionBatch([sut], use_bulk=True).prepare()
+        sut.execute()
+        self.assertEqual({}, batch.pending_mappings)
+
+    def test_flushing_twice_does_not_duplicate_mappings(self):
+        sut = self.create_with_ref('John')
+        batch = ActionBatch([sut], use_bulk=True).prepare()
+        sut.execute()
+        batch.flush()
+        batch.flush()
+        self.assertEqual(1, ExternalKeyMapping.objects.count())
+
+    def test_it_defers_new_objects_until_flushed(self):
+        actions = [CreateModelAction(TestPerson, ['first_name'],
+                                     {'first_name': name})
+                   for name in ['John', 'Jill', 'Jack']]
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        for action in actions:
+            action.execute()
+        self.assertEqual(0, TestPerson.objects.count())
+
+        with self.assertNumQueries(1):
+            batch.flush()
+        self.assertEqual(3, TestPerson.objects.count())
+
+    def test_it_resolves_the_write_database_once_per_model(self):
+        actions = [self.create_with_ref(name) for name in ['John', 'Jill']]
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        with patch('nsync.actions.router.db_for_write',
+                   return_value='default') as db_for_write:
+            for action in actions:
+                action.execute()
+            batch.flush()
+        self.assertEqual(1, db_for_write.call_args_list.count(
+            call(TestPerson)))
+        self.assertEqual(2, TestPerson.objects.count())
+
+    def test_it_sets_the_auto_now_fields_of_updated_objects(self):
+        house = TestHouse.objects.create(address='House1')
+        long_ago = datetime.datetime(2000, 1, 1)
+        TestHouse.objects.filter(pk=house.pk).update(last_updated=long_ago)
+        sut = UpdateModelAction(TestHouse, ['address'],
+                                {'address': 'House1', 'country': 'Belgium'})
+        batch = ActionBatch([sut], use_bulk=True).prepare()
+        sut.execute()
+        batch.flush()
+        house.refresh_from_db()
+        self.assertEqual('Belgium', house.country)
+        self.assertGreater(house.last_updated, long_ago)
+
+    @patch('nsync.actions.transaction.atomic')
+    def test_it_flushes_in_a_transaction_without_a_savepoint(self, atomic):
+        sut = self.create_with_ref('John')
+        batch = ActionBatch([sut], use_bulk=True).prepare()
+        sut.execute()
+        batch.flush()
+        atomic.assert_any_call(using='default', savepoint=False)
+        self.assertEqual(1, ExternalKeyMapping.objects.count())
+
+    def test_it_defers_deletes_if_all_of_the_actions_are_deletes(self):
+        for name in ['John', 'Jill', 'Jack']:
+            TestPerson.objects.create(first_name=name)
+        actions = [DeleteModelAction(TestPerson, ['first_name'],
+                                     {'first_name': name})
+                   for name in ['John', 'Jill']]
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        for action in actions:
+            action.execute()
+        self.assertEqual(3, TestPerson.objects.count())
+
+        batch.flush()
+        self.assertEqual(['Jack'], list(
+            TestPerson.objects.values_list('first_name', flat=True)))
+
+    def test_it_does_not_defer_deletes_mixed_with_other_actions(self):
+        TestPerson.objects.create(first_name='John')
+        delete = DeleteModelAction(TestPerson, ['first_name'],
+                                   {'first_name': 'John'})
+        create = CreateModelAction(TestPerson, ['first_name'],
+                                   {'first_name': 'John'})
+        batch = ActionBatch([delete, create], use_bulk=True).prepare()
+        delete.execute()
+        self.assertEqual(0, TestPerson.objects.count())
+        create.execute()
+        batch.flush()
+        self.assertEqual(1, TestPerson.objects.count())
+
+    @override_settings(NSYNC_BULK_BATCH_SIZE=2)
+    def test_the_batch_size_can_be_set(self):
+        actions = [CreateModelAction(TestPerson, ['first_name'],
+                                     {'first_name': name})
+                   for name in ['John', 'Jill', 'Jack']]
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        for action in actions:
+            action.execute()
+
+        with self.assertNumQueries(2):
+            batch.flush()
+        self.assertEqual(3, TestPerson.objects.count())
+
+    def test_the_batch_size_keeps_to_the_query_parameter_limit(self):
+        batch = ActionBatch([])
+        self.assertEqual(ActionBatch.BULK_BATCH_SIZE,
+                         batch.bulk_batch_size(2))
+        self.assertEqual(ActionBatch.MAX_QUERY_PARAMS // 100,
+                         batch.bulk_batch_size(100))
+        self.assertEqual(1, batch.bulk_batch_size(
+            ActionBatch.MAX_QUERY_PARAMS + 1))
+
+    def test_it_saves_multi_table_inherited_objects_immediately(self):
+        sut = CreateModelAction(TestBuilder, ['first_name'],
+                                {'first_name': 'Bob'})
+        batch = ActionBatch([sut], use_bulk=True).prepare()
+        sut.execute()
+        self.assertEqual({}, batch.pending_creates)
+        self.assertEqual(1, TestBuilder.objects.count())
+
+    def test_it_defers_updates_until_flushed(self):
+        for name in ['John', 'Jill']:
+            TestPerson.objects.create(first_name=name)
+        actions = [UpdateModelAction(TestPerson, ['first_name'],
+                                     {'first_name': name, 'last_name': 'Smith'})
+                   for name in ['John', 'Jill']]
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        for action in actions:
+            action.execute()
+        self.assertEqual(0, TestPerson.objects.filter(last_name='Smith').count())
+
+        # A single update, in a savepoint
+        with self.assertNumQueries(3):
+            batch.flush()
+        self.assertEqual(2, TestPerson.objects.filter(last_name='Smith').count())
+
+    def test_it_only_skips_the_updates_that_fail(self):
+        names = ['John', 'Jill', 'Jack', 'Jane']
+        for name in names:
+            TestPerson.objects.create(first_name=name)
+        actions = [UpdateModelAction(TestPerson, ['first_name'],
+                                     {'first_name': name, 'last_name': 'Smith'})
+                   for name in names]
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        for action in actions:
+            action.execute()
+        # Make the update of Jack fail
+        for obj, _ in batch.pending_updates[TestPerson].values():
+            if obj.first_name == 'Jack':
+                obj.last_name = None
+
+        batch.flush()
+        self.assertEqual(
+            {'John', 'Jill', 'Jane'},
+            set(TestPerson.objects.filter(last_name='Smith').values_list(
+                'first_name', flat=True)))
+
+    def test_it_does_not_map_the_objects_whose_update_fails(self):
+        for name in ['John', 'Jack']:
+            TestPerson.objects.create(first_name=name)
+        actions = [UpdateModelWithReferenceAction(
+                       self.external_system, TestPerson, name, ['first_name'],
+                       {'first_name': name, 'last_name': 'Smith'})
+                   for name in ['John', 'Jack']]
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        for action in actions:
+            action.execute()
+        # Make the update of Jack fail
+        for obj, _ in batch.pending_updates[TestPerson].values():
+            if obj.first_name == 'Jack':
+                obj.last_name = None
+
+        batch.flush()
+        self.assertEqual(['John'], list(
+            ExternalKeyMapping.objects.values_list('external_key', flat=True)))
+        self.assertNotIn((self.external_system.pk, 'Jack'), batch.mappings)
+
+    def test_it_combines_updates_to_the_same_object(self):
+        john = TestPerson.objects.create(first_name='John')
+        actions = [
+            UpdateModelAction(TestPerson, ['first_name'],
+                              {'first_name': 'John', 'last_name': 'Smith'}),
+            UpdateModelAction(TestPerson, ['first_name'],
+                              {'first_name': 'John', 'age': '42'})]
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        for action in actions:
+            action.execute()
+        batch.flush()
+        john.refresh_from_db()
+        self.assertEqual('Smith', john.last_name)
+        self.assertEqual(42, john.age)
+
+    def test_it_defers_reference_deletes_until_flushed(self):
+        for name in ['John', 'Jill']:
+            person = TestPerson.objects.create(first_name=name)
+            ExternalKeyMapping.objects.create(
+                external_system=self.external_system,
+                external_key=name,
+                content_type=ContentType.objects.get_for_model(TestPerson),
+                content_object=person,
+                object_id=person.id)
+        actions = [DeleteExternalReferenceAction(self.external_system, name)
+                   for name in ['John', 'Jill', 'Jack']]
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        with self.assertNumQueries(0):
+            for action in actions:
+                action.execute()
+        self.assertEqual(2, ExternalKeyMapping.objects.count())
+
+        with self.assertNumQueries(1):
+            batch.flush()
+        self.assertEqual(0, ExternalKeyMapping.objects.count())
+
+    def test_it_drops_pending_mappings_that_are_deleted(self):
+        create = self.create_with_ref('John')
+        delete = DeleteExternalReferenceAction(self.external_system, 'John')
+        batch = ActionBatch([create, delete], use_bulk=True).prepare()
+        create.execute()
+        delete.execute()
+        batch.flush()
+        self.assertEqual(1, TestPerson.objects.count())
+        self.assertEqual(0, ExternalKeyMapping.objects.count())
+        self.assertEqual({}, batch.pending_reference_deletes)
+
+    def test_it_does_not_create_duplicate_objects(self):
+        actions = [CreateModelAction(TestPerson, ['first_name'],
+                                     {'first_name': 'John'})
+                   for _ in range(2)]
+        batch = ActionBatch(actions, use_bulk=True).prepare()
+        for action in actions:
+            action.execute()
+        batch.flush()
+        self.assertEqual(1, TestPerson.objects.count())
+
+    def test_it_updates_objects_that_are_still_to_be_created(self):
+        create = CreateModelAction(TestPerson, ['first_name'],
+                                   {'first_name': 'John'})
+        update = UpdateModelAction(TestPerson, ['first_name'],
+                                   {'first_name': 'John', 'last_name': 'Smith'})
+        batch = ActionBatch([create, update], use_bulk=True).prepare()
+        create.execute()
+        update.execute()
+        batch.flush()
+        self.assertEqual(['Smith'], list(
+            TestPerson.objects.values_list('last_name', flat=True)))
+
+    def test_it_finds_related_objects_that_are_still_to_be_created(self):
+        create_person = CreateModelAction(TestPerson, ['first_name'],
+                                          {'first_name': 'John'})
+        create_house = CreateModelAction(
+            TestHouse, ['address'],
+            {'address': 'House1', 'owner=>first_name': 'John'})
+        batch = ActionBatch([create_person, create_house],
+                            use_bulk=True).prepare()
+        create_person.execute()
+        house = create_house.execute()
+        batch.flush()
+        self.assertEqual('John', house.owner.first_name)
+        self.assertEqual(1, TestHouse.objects.filter(
+            owner__first_name='John').count())
+
+    def test_it_replaces_matched_objects_that_are_still_to_be_created(self):
+        jill = TestPerson.objects.create(first_name='Jill')
+        ExternalKeyMapping.objects.create(
+            external_system=self.external_system,
+            external_key='Jill',
+            content_type=ContentType.objects.get_for_model(TestPerson),
+            content_object=jill,
+            object_id=jill.id)
+        create = self.create_with_ref('John')
+        update = UpdateModelWithReferenceAction(
+            self.external_system, TestPerson, 'Jill', ['first_name'],
+            {'first_name': 'John'}, force_update=True)
+        batch = ActionBatch([create, update], use_bulk=True).prepare()
+        create.execute()
+        update.execute()
+        batch.flush()
+        self.assertEqual([('John', jill.pk)], list(
+            TestPerson.objects.values_list('first_name', 'pk')))
+
+    def test_it_deletes_objects_that_are_still_to_be_created(self):
+        create = CreateModelAction(TestPerson, ['first_name'],
+                                   {'first_name': 'John'})
+        delete = DeleteModelAction(TestPerson, ['first_name'],
+                                   {'first_name': 'John'})
+        batch = ActionBatch([create, delete], use_bulk=True).prepare()
+        create.execute()
+        delete.execute()
+        batch.flush()
+        self.assertEqual(0, TestPerson.objects.count())
+
+    def test_it_does_not_write_the_primary_key_in_bulk(self):
+        john = TestPerson.objects.create(first_name='John')
+        sut = UpdateModelAction(TestPerson, ['first_name'],
+                                {'first_name': 'John',
+                                 'id': str(john.pk),
+                                 'last_name': 'Smith'},
+                                force_update=True)
+        batch = ActionBatch([sut], use_bulk=True).prepare()
+        sut.execute()
+        batch.flush()
+        john.refresh_from_db()
+        self.assertEqual('Smith', john.last_name)
+
+
+class TestUpdateFromFieldsChangedFields(TestCase):
+    def test_it_returns_the_names_of_the_fields_it_set(self):
+        person = TestPerson.objects.create(first_name='Jill')
+        house = TestHouse(address='Bottom of the hill')
+        changed = ModelAction(
+            TestHouse, ['address'],
+            {'address': 'Bottom of the hill', 'country': 'Australia',
+             'not_a_field': 'value', 'owner=>first_name': 'Jill'}
+        ).update_from_fields(house, True)
+        self.assertEqual({'address', 'country', 'owner'}, changed)
+        self.assertEqual(person, house.owner)
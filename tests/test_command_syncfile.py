@@ -4,6 +4,7 @@ from unittest.mock import MagicMock, patch
 from django.contrib.contenttypes.models import ContentType
 from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.db.models.signals import post_save
 from django.test import TestCase
 from nsync.management.commands.syncfile import SyncFileAction
 from nsync.models import ExternalKeyMapping, ExternalSystem
@@ -17,29 +18,35 @@ class TestSyncFileCommand(TestCase):
             call_command('syncfile', 'systemName', 'tests', 'TestPerson',
                          'file')
 
+    def test_command_raises_error_if_chunk_size_is_not_positive(self):
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.csv') as f:
+            with self.assertRaisesRegex(CommandError, 'chunk_size'):
+                call_command('syncfile', 'systemName', 'tests', 'TestPerson',
+                             f.name, '--chunk_size', '0')
+
 
 class TestSyncFileAction(TestCase):
     @patch('nsync.management.commands.syncfile.CsvActionFactory')
-    @patch('csv.DictReader')
-    def test_data_flow(self, DictReader, CsvActionFactory):
+    @patch('csv.reader')
+    def test_data_flow(self, reader, CsvActionFactory):
         file = MagicMock()
-        row = MagicMock()
-        row_provider = MagicMock()
-        DictReader.return_value = row_provider
-        row_provider.__iter__.return_value = [row]
+        headers = MagicMock()
+        row_provider = iter([headers])
+        reader.return_value = row_provider
         model_mock = MagicMock()
         external_system_mock = MagicMock()
         action_mock = MagicMock()
-        CsvActionFactory.return_value.from_dict.return_value = [action_mock]
+        CsvActionFactory.return_value.from_rows.return_value = [action_mock]
         SyncFileAction.sync(external_system_mock, model_mock, file, False)
-        DictReader.assert_called_with(file)
+        reader.assert_called_with(file)
         CsvActionFactory.assert_called_with(model_mock, external_system_mock)
 
-        CsvActionFactory.return_value.from_dict.assert_called_with(row)
+        CsvActionFactory.return_value.from_rows.assert_called_with(
+            headers, row_provider)
         action_mock.execute.assert_called_once_with()
 
-    @patch('nsync.management.commands.syncfile.TransactionSyncPolicy')
-    @patch('nsync.management.commands.syncfile.BasicSyncPolicy')
+    @patch('nsync.management.commands.utils.TransactionSyncPolicy')
+    @patch('nsync.management.commands.utils.BasicSyncPolicy')
     @patch('nsync.management.commands.syncfile.CsvActionFactory')
     def test_it_wraps_the_basic_policy_in_a_transaction_policy_if_configured(
             self, CsvActionFactory,
@@ -48,6 +55,17 @@ class TestSyncFileAction(TestCase):
         TransactionSyncPolicy.assert_called_with(BasicSyncPolicy.return_value)
         TransactionSyncPolicy.return_value.execute.assert_called_once_with()
 
+    @patch('nsync.management.commands.syncfile.iterate_in_background')
+    @patch('nsync.management.commands.syncfile.build_policy')
+    @patch('nsync.management.commands.syncfile.CsvActionFactory')
+    def test_it_closes_the_background_iterator_if_the_sync_fails(
+            self, CsvActionFactory, build_policy, iterate_in_background):
+        build_policy.return_value.execute.side_effect = ValueError()
+        with self.assertRaises(ValueError):
+            SyncFileAction.sync(MagicMock(), MagicMock(), ['header', 'row'],
+                                True, chunk_size=10)
+        iterate_in_background.return_value.close.assert_called_once_with()
+
 
 class TestSyncSingleFileIntegrationTests(TestCase):
     def test_create_and_update(self):
@@ -192,3 +210,87 @@ class TestSyncSingleFileIntegrationTests(TestCase):
             external_key='House3Key').exists())
         self.assertTrue(ExternalKeyMapping.objects.filter(
             external_key='House4Key').exists())
+
+    def test_create_and_update_with_external_refs_in_bulk(self):
+        house1 = TestHouse.objects.create(address='House1')
+
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w')
+        csv_file_obj.writelines([
+            'external_key,action_flags,match_on,address,country\n',
+            'House1Key,cu,address,House1,Australia\n',
+            'House2Key,cu,address,House2,Australia\n',
+        ])
+        csv_file_obj.seek(0)
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     csv_file_obj.name, use_bulk=True)
+
+        house1.refresh_from_db()
+        house2 = TestHouse.objects.get(address='House2')
+        self.assertEqual('Australia', house1.country)
+        self.assertEqual('Australia', house2.country)
+        self.assertEqual(2, ExternalKeyMapping.objects.count())
+        self.assertEqual(house1, ExternalKeyMapping.objects.get(
+            external_key='House1Key').content_object)
+        self.assertEqual(house2, ExternalKeyMapping.objects.get(
+            external_key='House2Key').content_object)
+
+    def test_create_and_update_in_chunks(self):
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w')
+        csv_file_obj.writelines(
+            ['external_key,action_flags,match_on,address,country\n'] +
+            ['House{0}Key,cu,address,House{0},Australia\n'.format(i)
+             for i in range(5)])
+        csv_file_obj.seek(0)
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     csv_file_obj.name, use_bulk=True, chunk_size=2)
+
+        self.assertEqual(5, TestHouse.objects.filter(
+            country='Australia').count())
+        self.assertEqual(5, ExternalKeyMapping.objects.count())
+
+    def test_create_with_signals_disabled(self):
+        receiver = MagicMock()
+        post_save.connect(receiver, sender=TestHouse)
+        self.addCleanup(post_save.disconnect, receiver, sender=TestHouse)
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w')
+        csv_file_obj.writelines([
+            'action_flags,match_on,address,country\n',
+            'c,address,House1,Australia\n',
+        ])
+        csv_file_obj.seek(0)
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     csv_file_obj.name, disable_signals=True)
+
+        self.assertTrue(TestHouse.objects.filter(address='House1').exists())
+        receiver.assert_not_called()
+
+    def test_create_with_a_line_break_in_a_quoted_value(self):
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w', newline='')
+        csv_file_obj.writelines([
+            'action_flags,match_on,address,country\r\n',
+            'c,address,"House1\r\nSecond line",Australia\r\n',
+        ])
+        csv_file_obj.seek(0)
+
+        call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                     csv_file_obj.name)
+
+        self.assertTrue(TestHouse.objects.filter(
+            address='House1\r\nSecond line').exists())
+
+    def test_the_transaction_can_be_turned_off(self):
+        csv_file_obj = tempfile.NamedTemporaryFile(mode='w')
+        csv_file_obj.writelines([
+            'action_flags,match_on,address\n',
+            'c,address,House1\n',
+        ])
+        csv_file_obj.seek(0)
+
+        with patch('nsync.management.commands.syncfile.'
+                   'SyncFileAction.sync') as sync:
+            call_command('syncfile', 'TestSystem', 'tests', 'TestHouse',
+                         csv_file_obj.name, '--as_transaction', 'False')
+            self.assertFalse(sync.call_args[0][3])
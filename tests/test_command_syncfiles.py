@@ -5,6 +5,7 @@ from unittest.mock import MagicMock, patch
 from django.contrib.contenttypes.models import ContentType
 from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.db.models.signals import post_save
 from django.test import TestCase
 from nsync.management.commands.syncfiles import TestableCommand, \
     TargetExtractor, DEFAULT_FILE_REGEX
@@ -41,10 +42,13 @@ class TestTestableCommand(TestCase):
             'file_name_regex': '',
             'create_external_system': '',
             'smart_ordering': '',
-            'as_transaction': ''
+            'as_transaction': '',
+            'use_bulk': False,
+            'chunk_size': None,
+            'disable_signals': False
         }
 
-    @patch('nsync.management.commands.syncfiles.BasicSyncPolicy')
+    @patch('nsync.management.commands.utils.BasicSyncPolicy')
     def test_it_uses_the_basic_policy_if_smart_ordering_is_false(self, Policy):
         self.defaults['smart_ordering'] = False
         actions_list = MagicMock()
@@ -53,10 +57,11 @@ class TestTestableCommand(TestCase):
                           return_value=actions_list):
             sut = TestableCommand(**self.defaults)
             sut.execute()
-            Policy.assert_called_with(actions_list)
+            Policy.assert_called_with(actions_list, use_bulk=False,
+                                      chunk_size=None)
             Policy.return_value.execute.assert_called_once_with()
 
-    @patch('nsync.management.commands.syncfiles.OrderedSyncPolicy')
+    @patch('nsync.management.commands.utils.OrderedSyncPolicy')
     def test_it_uses_the_ordered_policy_if_smart_ordering_is_true(self,
                                                                   Policy):
         self.defaults['smart_ordering'] = True
@@ -66,11 +71,12 @@ class TestTestableCommand(TestCase):
                           return_value=actions_list):
             sut = TestableCommand(**self.defaults)
             sut.execute()
-            Policy.assert_called_with(actions_list)
+            Policy.assert_called_with(actions_list, use_bulk=False,
+                                      chunk_size=None)
             Policy.return_value.execute.assert_called_once_with()
 
-    @patch('nsync.management.commands.syncfiles.TransactionSyncPolicy')
-    @patch('nsync.management.commands.syncfiles.BasicSyncPolicy')
+    @patch('nsync.management.commands.utils.TransactionSyncPolicy')
+    @patch('nsync.management.commands.utils.BasicSyncPolicy')
     def test_it_wraps_the_basic_policy_in_a_transaction_policy_if_configured(
             self, BasicSyncPolicy, TransactionSyncPolicy):
         self.defaults['smart_ordering'] = False
@@ -95,7 +101,10 @@ class TestTestableCommand(TestCase):
             'file_name_regex': DEFAULT_FILE_REGEX,
             'create_external_system': MagicMock(),
             'smart_ordering': MagicMock(),
-            'as_transaction': MagicMock()
+            'as_transaction': MagicMock(),
+            'use_bulk': MagicMock(),
+            'chunk_size': MagicMock(),
+            'disable_signals': MagicMock()
         })
 
         with self.assertRaises(CommandError):
@@ -169,6 +178,27 @@ class TestSyncSingleFileIntegrationTests(TestCase):
         with self.assertRaises(Exception):
             house2.refresh_from_db()
 
+    def test_it_finds_each_external_system_once(self):
+        files = []
+        for address in ['House1', 'House2']:
+            csv_file_obj = tempfile.NamedTemporaryFile(
+                mode='w', prefix='TestSystem_tests_TestHouse_', suffix='.csv')
+            csv_file_obj.writelines([
+                'action_flags,match_on,address\n',
+                'c,address,{}\n'.format(address),
+            ])
+            csv_file_obj.seek(0)
+            files.append(csv_file_obj)
+
+        with patch('nsync.management.commands.syncfiles.'
+                   'ExternalSystemHelper.find',
+                   return_value=ExternalSystem.objects.create(
+                       name='TestSystem')) as find:
+            call_command('syncfiles', *[f.name for f in files])
+            find.assert_called_once_with('TestSystem', True)
+
+        self.assertEqual(2, TestHouse.objects.count())
+
     def test_create_and_update_with_external_refs(self):
         house1 = TestHouse.objects.create(address='House1')
         house2 = TestHouse.objects.create(address='House2')
@@ -281,3 +311,41 @@ class TestSyncSingleFileIntegrationTests(TestCase):
         call_command('syncfiles', file1.name, file2.name)
 
         self.assertEqual(0, TestHouse.objects.count())
+
+    def test_create_with_signals_disabled(self):
+        receiver = MagicMock()
+        post_save.connect(receiver, sender=TestHouse)
+        self.addCleanup(post_save.disconnect, receiver, sender=TestHouse)
+        csv_file_obj = tempfile.NamedTemporaryFile(
+            mode='w', prefix='TestSystem_tests_TestHouse_', suffix='.csv')
+        csv_file_obj.writelines([
+            'action_flags,match_on,address\n',
+            'c,address,House1\n',
+        ])
+        csv_file_obj.seek(0)
+
+        call_command('syncfiles', csv_file_obj.name, disable_signals=True)
+
+        self.assertTrue(TestHouse.objects.filter(address='House1').exists())
+        receiver.assert_not_called()
+
+    def test_it_links_objects_created_in_the_same_bulk_batch(self):
+        people = tempfile.NamedTemporaryFile(
+            mode='w', prefix='TestSystem_tests_TestPerson_', suffix='.csv')
+        people.writelines([
+            'action_flags,match_on,first_name\n',
+            'c,first_name,John\n',
+        ])
+        people.seek(0)
+        houses = tempfile.NamedTemporaryFile(
+            mode='w', prefix='TestSystem_tests_TestHouse_', suffix='.csv')
+        houses.writelines([
+            'action_flags,match_on,address,owner=>first_name\n',
+            'c,address,House1,John\n',
+        ])
+        houses.seek(0)
+
+        call_command('syncfiles', people.name, houses.name, use_bulk=True)
+
+        house = TestHouse.objects.get(address='House1')
+        self.assertEqual('John', house.owner.first_name)
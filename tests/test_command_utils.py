@@ -1,15 +1,30 @@
-from unittest.mock import MagicMock, patch
+import argparse
+import threading
+from unittest.mock import ANY, MagicMock, patch
 
 from django.core.management.base import CommandError
+from django.db.models.signals import post_save
 from django.test import TestCase
 from nsync.actions import SyncActions
+from nsync.policies import (
+    BasicSyncPolicy,
+    OrderedSyncPolicy,
+    TransactionSyncPolicy
+)
 from nsync.management.commands.utils import (
     ExternalSystemHelper,
     ModelFinder,
     SupportedFileChecker,
     CsvSyncActionsDecoder,
     CsvSyncActionsEncoder,
-    CsvActionFactory)
+    CsvActionFactory,
+    build_policy,
+    iterate_in_background,
+    model_signals_disconnected,
+    positive_int,
+    str_to_bool)
+
+from tests.models import TestHouse, TestPerson
 
 
 class TestExternalSystemHelper(TestCase):
@@ -78,6 +93,20 @@ class TestCsvSyncActionsDecoder(TestCase):
         self.assertTrue(CsvSyncActionsDecoder.decode('d').delete)
         self.assertTrue(CsvSyncActionsDecoder.decode('D').delete)
 
+    def test_it_decodes_combined_flags(self):
+        result = CsvSyncActionsDecoder.decode('cU*')
+        self.assertTrue(result.create)
+        self.assertTrue(result.update)
+        self.assertFalse(result.delete)
+        self.assertTrue(result.force)
+
+    def test_it_ignores_unknown_flags(self):
+        result = CsvSyncActionsDecoder.decode('x d ')
+        self.assertFalse(result.create)
+        self.assertFalse(result.update)
+        self.assertTrue(result.delete)
+        self.assertFalse(result.force)
+
     def test_it_produces_object_with_no_actions_if_input_invalid(self):
         result = CsvSyncActionsDecoder.decode(123)
         self.assertFalse(result.create)
@@ -113,6 +142,16 @@ class TestCsvActionFactory(TestCase):
                 {'other_key': 'value'})
             self.assertEqual(build_method.return_value, result)
 
+    def test_from_dict_does_not_change_the_values(self):
+        values = {'action_flags': 'c', 'match_on': 'field',
+                  'external_key': 'key', 'field': 'value'}
+        original = dict(values)
+        with patch.object(self.sut, 'build') as build_method:
+            self.sut.from_dict(values)
+            build_method.assert_called_with(ANY, ['field'], 'key',
+                                            {'field': 'value'})
+        self.assertEqual(original, values)
+
     def test_returns_an_empty_list_if_no_actions_in_input(self):
         self.assertEqual([], self.sut.from_dict(None))
 
@@ -123,3 +162,176 @@ class TestCsvActionFactory(TestCase):
     def test_it_raises_an_error_if_the_match_field_key_is_not_in_values(self):
         with self.assertRaises(KeyError):
             self.sut.from_dict({'action_flags': ''})
+
+    def test_from_rows_builds_the_same_actions_as_from_dict(self):
+        headers = ['action_flags', 'match_on', 'external_key', 'field', 'other']
+        rows = [['c', 'field other', 'key', 'value', 'other value'],
+                [],
+                ['u', 'field', '', 'value2']]
+        with patch.object(self.sut, 'build') as build_method:
+            build_method.side_effect = lambda *args: [args]
+            result = self.sut.from_rows(headers, iter(rows))
+            expected = []
+            for row in [rows[0], rows[2] + [None]]:
+                expected.extend(self.sut.from_dict(dict(zip(headers, row))))
+        self.assertEqual(2, len(result))
+        for actual, wanted in zip(result, expected):
+            self.assertEqual(str(wanted[0]), str(actual[0]))
+            self.assertEqual(wanted[1:], actual[1:])
+
+    def test_from_rows_does_not_need_an_external_key_column(self):
+        with patch.object(self.sut, 'build') as build_method:
+            self.sut.from_rows(['action_flags', 'match_on', 'field'],
+                               [['c', 'field', 'value']])
+            build_method.assert_called_with(ANY, ['field'], None,
+                                            {'field': 'value'})
+
+    def test_from_rows_splits_each_match_on_value_once(self):
+        with patch.object(self.sut, 'build') as build_method:
+            build_method.side_effect = lambda *args: [args[1]]
+            result = self.sut.from_rows(
+                ['action_flags', 'match_on', 'field', 'other'],
+                [['c', 'field other', 'value', 'a'],
+                 ['c', 'field other', 'value2', 'b'],
+                 ['c', 'field', 'value3', 'c']])
+        self.assertEqual([['field', 'other'], ['field', 'other'], ['field']],
+                         result)
+        self.assertIs(result[0], result[1])
+
+    def test_from_rows_raises_an_error_if_the_action_flag_column_is_missing(
+            self):
+        with self.assertRaises(KeyError):
+            self.sut.from_rows(['match_on'], [['field']])
+
+    def test_from_rows_raises_an_error_if_the_match_on_column_is_missing(
+            self):
+        with self.assertRaises(KeyError):
+            self.sut.from_rows(['action_flags'], [['c']])
+
+
+class TestIterateInBackground(TestCase):
+    def setUp(self):
+        self.threads = threading.active_count()
+
+    def test_it_produces_all_of_the_items_in_order(self):
+        self.assertEqual(list(range(10)),
+                         list(iterate_in_background(range(10), 3)))
+
+    def test_it_raises_the_errors_of_the_iterable(self):
+        def items():
+            yield 1
+            raise ValueError('Bad item')
+
+        with self.assertRaises(ValueError):
+            list(iterate_in_background(items(), 1))
+
+    def test_it_stops_the_background_thread_if_not_finished(self):
+        consumed = iterate_in_background(iter(range(1000)), 1, max_chunks=1)
+        self.assertEqual(0, next(consumed))
+        consumed.close()
+        self.assertEqual(0, threading.active_count() - self.threads)
+
+
+class TestModelSignalsDisconnected(TestCase):
+    def setUp(self):
+        self.house_receiver = MagicMock()
+        self.person_receiver = MagicMock()
+        self.any_receiver = MagicMock()
+        post_save.connect(self.house_receiver, sender=TestHouse)
+        post_save.connect(self.person_receiver, sender=TestPerson)
+        post_save.connect(self.any_receiver)
+        self.addCleanup(post_save.disconnect, self.house_receiver,
+                        sender=TestHouse)
+        self.addCleanup(post_save.disconnect, self.person_receiver,
+                        sender=TestPerson)
+        self.addCleanup(post_save.disconnect, self.any_receiver)
+
+    def test_it_only_silences_the_receivers_for_the_model(self):
+        with model_signals_disconnected(TestHouse):
+            TestHouse.objects.create(address='House')
+            TestPerson.objects.create(first_name='Person')
+        self.house_receiver.assert_not_called()
+        self.assertEqual(1, self.person_receiver.call_count)
+        self.assertEqual(2, self.any_receiver.call_count)
+
+    def test_it_silences_the_receivers_for_several_models(self):
+        with model_signals_disconnected(TestHouse, TestPerson):
+            TestHouse.objects.create(address='House')
+            TestPerson.objects.create(first_name='Person')
+        self.house_receiver.assert_not_called()
+        self.person_receiver.assert_not_called()
+        self.assertEqual(2, self.any_receiver.call_count)
+
+    def test_it_restores_the_receivers_on_exit(self):
+        with self.assertRaises(ValueError):
+            with model_signals_disconnected(TestHouse):
+                raise ValueError()
+        TestHouse.objects.create(address='House')
+        self.assertEqual(1, self.house_receiver.call_count)
+
+    def test_it_restores_the_dispatch_uid_of_the_receivers(self):
+        receiver = MagicMock()
+        post_save.connect(receiver, sender=TestHouse, dispatch_uid='house')
+        self.addCleanup(post_save.disconnect, sender=TestHouse,
+                        dispatch_uid='house')
+        with model_signals_disconnected(TestHouse):
+            TestHouse.objects.create(address='House')
+        receiver.assert_not_called()
+        self.assertTrue(post_save.disconnect(sender=TestHouse,
+                                             dispatch_uid='house'))
+
+    def test_it_restores_the_weak_method_receivers(self):
+        class Listener:
+            calls = 0
+
+            def receive(self, **kwargs):
+                self.calls += 1
+
+        listener = Listener()
+        post_save.connect(listener.receive, sender=TestHouse)
+        self.addCleanup(post_save.disconnect, listener.receive,
+                        sender=TestHouse)
+        with model_signals_disconnected(TestHouse):
+            TestHouse.objects.create(address='House')
+        TestHouse.objects.create(address='House')
+        self.assertEqual(1, listener.calls)
+
+
+class TestBuildPolicy(TestCase):
+    def test_it_builds_a_basic_policy_in_a_transaction_by_default(self):
+        actions = [MagicMock()]
+        policy = build_policy(actions)
+        self.assertIsInstance(policy, TransactionSyncPolicy)
+        self.assertIsInstance(policy.policy, BasicSyncPolicy)
+        self.assertIs(actions, policy.policy.actions)
+
+    def test_it_builds_an_ordered_policy_without_a_transaction(self):
+        policy = build_policy([], ordered=True, use_transaction=False,
+                              use_bulk=True, chunk_size=10)
+        self.assertIsInstance(policy, OrderedSyncPolicy)
+        self.assertTrue(policy.use_bulk)
+        self.assertEqual(10, policy.chunk_size)
+
+
+class TestStrToBool(TestCase):
+    def test_it_converts_the_true_values(self):
+        for value in ['True', 'true', 'yes', 'Y', 'on', '1', True]:
+            self.assertIs(True, str_to_bool(value), value)
+
+    def test_it_converts_the_false_values(self):
+        for value in ['False', 'false', 'no', 'N', 'off', '0', False]:
+            self.assertIs(False, str_to_bool(value), value)
+
+    def test_it_raises_an_error_for_other_values(self):
+        with self.assertRaises(argparse.ArgumentTypeError):
+            str_to_bool('maybe')
+
+
+class TestPositiveInt(TestCase):
+    def test_it_converts_positive_numbers(self):
+        self.assertEqual(1000, positive_int('1000'))
+
+    def test_it_raises_an_error_for_other_values(self):
+        for value in ['0', '-1', 'many']:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                positive_int(value)
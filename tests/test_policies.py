@@ -1,4 +1,4 @@
-from unittest.mock import MagicMock, call
+from unittest.mock import MagicMock, call, patch
 
 from django.test import TestCase
 from nsync.policies import BasicSyncPolicy, OrderedSyncPolicy
@@ -11,6 +11,23 @@ class TestBasicSyncPolicy(TestCase):
         for action in actions:
             action.execute.assert_called_once_with()
 
+    @patch('nsync.policies.ActionBatch')
+    def test_it_executes_the_actions_in_chunks(self, ActionBatch):
+        actions = [MagicMock() for _ in range(5)]
+        BasicSyncPolicy(iter(actions), chunk_size=2).execute()
+        batch = call().prepare()
+        ActionBatch.assert_has_calls([
+            call(actions[0:2], False), call().prepare(), batch.flush(),
+            call(actions[2:4], False), call().prepare(), batch.flush(),
+            call(actions[4:], False), call().prepare(), batch.flush()])
+        for action in actions:
+            action.execute.assert_called_once_with()
+
+    def test_it_raises_an_error_if_the_chunk_size_is_not_positive(self):
+        for chunk_size in [0, -1]:
+            with self.assertRaises(ValueError):
+                BasicSyncPolicy([MagicMock()], chunk_size=chunk_size).execute()
+
 
 class TestOrderedSyncPolicy(TestCase):
     def test_it_calls_in_order_create_update_delete(self):
@@ -37,3 +54,29 @@ class TestOrderedSyncPolicy(TestCase):
             call.create.execute(),
             call.update.execute(),
             call.delete.execute()])
+
+    @patch('nsync.policies.ActionBatch')
+    def test_it_flushes_each_kind_of_action_separately(self, ActionBatch):
+        actions = []
+        for type in ['delete', 'create', 'update', 'create']:
+            action = MagicMock()
+            action.type = type
+            actions.append(action)
+
+        OrderedSyncPolicy(actions, chunk_size=5).execute()
+        self.assertEqual(
+            [call([actions[1], actions[3]], False),
+             call([actions[2]], False),
+             call([actions[0]], False)],
+            [c for c in ActionBatch.mock_calls if c[0] == ''])
+
+    def test_it_executes_all_of_the_actions_from_an_iterator(self):
+        actions = []
+        for type in ['delete', 'create', 'update']:
+            action = MagicMock()
+            action.type = type
+            actions.append(action)
+
+        OrderedSyncPolicy(iter(actions)).execute()
+        for action in actions:
+            action.execute.assert_called_once_with()